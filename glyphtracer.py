@@ -17,130 +17,212 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys
+import os, sys, threading, time
+
+if __name__ == "__main__" and sys.argv[1:2] == ['batch']:
+    # Batch mode does not need Qt, so do not spend time loading it.
+    import gtbatch
+    sys.exit(gtbatch.main(sys.argv[2:]))
+
 import PyQt5.QtWidgets as QtWidgets
 import PyQt5.QtCore as QtCore
 import PyQt5.QtGui as QtGui
 from gtlib import *
+from gtcache import TraceCache
+from gtproject import ProjectFile
+from gtsegment import bitmap_from_qimage, iter_segment, NoiseFilter, no_filter
+import gtprofile
+from gtprofile import profile
 import math
 
 start_dialog = None
 main_win = None
 app = None
 
-def detect_black_index(image):
-    colortable = image.colorTable()
-    assert(len(colortable) == 2)
-    if(colortable[0] > colortable[1]):
-        return 1
-    return 0
-
-def calculate_horizontal_sums(image, show_progress):
-    (w, h) = (image.width(), image.height())
-    black_index = detect_black_index(image)
-    if show_progress:
-        prog = QtWidgets.QProgressDialog("Vertical splitting", '', 0, h)
-        prog.show()
-    sums = []
-    for j in range(h):
-        total = 0
-        for i in range(w):
-            if image.pixelIndex(i, j) == black_index:
-                total += 1
-        sums.append(total)
-        if show_progress:
-            prog.setValue(j)
-    if show_progress:
-        prog.hide()
-    return sums
-
-def calculate_cutlines_locations(sums):
-    element_strips = []
-    cutoff = 0
-
-    if len(sums) == 0:
-        return []
-    if sums[0] <= cutoff:
-        background_strip = True
-    else:
-        background_strip = False
-    strip_start = 0
+max_zoom = 5
 
-    for i in range(len(sums)):
-        if sums[i] <= cutoff:
-            background = True
-        else:
-            background = False
-        if background == background_strip:
-            continue
-
-        # We crossed a region.
-        if background:
-           strip_end = i-1;
-           element_strips.append((strip_start, strip_end))
-        strip_start = i
-        background_strip = background
-
-    if strip_start < len(sums) and not background_strip:
-        strip_end = len(sums) - 1
-        element_strips.append((strip_start, strip_end))
-    return element_strips
-
-def calculate_letter_boxes(image, xstrips):
-    boxes = []
-    (w, h) = (image.width(), image.height())
-    rotate = QtGui.QTransform()
-    rotate.rotate(90)
-    prog = QtWidgets.QProgressDialog("Horizontal splitting", '', 0, len(xstrips))
-    prog.show()
-    stripnum = 0
-    for xs in xstrips:
-        (y0, y1) = xs
-        cur_image = image.copy(0, y0, w, y1-y0).transformed(rotate)
-        ystrips = calculate_cutlines_locations(calculate_horizontal_sums(cur_image, False))
-        for ys in ystrips:
-            (x0, x1) = ys
-            box = LetterBox(QtCore.QRect(x0, y0, x1-x0, y1-y0))
-            boxes.append(box)
-        prog.setValue(stripnum)
-        stripnum += 1
-    prog.hide()
-    return boxes
+class SegmentationWorker(QtCore.QThread):
+    """Segments a bitmap in a background thread.
+
+    The boxes of every row strip are sent with rects_found as soon as
+    they are known. Requesting interruption stops after the current
+    band of rows or strip."""
+    rects_found = QtCore.pyqtSignal(object)
+    progress = QtCore.pyqtSignal(int, int)
+
+    def __init__(self, bitmap, segmentation, noise=no_filter):
+        super().__init__()
+        self.bitmap = bitmap
+        self.segmentation = segmentation
+        self.noise = noise
+        self.completed = False
+
+    def run(self):
+        for (rects, done, total) in iter_segment(self.bitmap, self.segmentation, self.noise,
+                                                 self.isInterruptionRequested):
+            if self.isInterruptionRequested():
+                return
+            self.rects_found.emit(rects)
+            self.progress.emit(done, total)
+        # iter_segment also ends early when interrupted.
+        self.completed = not self.isInterruptionRequested()
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+class ZoomPyramid(QtCore.QThread):
+    """Downscaled copies of an image for every zoom level.
+
+    The levels are built in a background thread, each one from the
+    previous level. Building stops if the levels would use more
+    than max_bytes of memory."""
+    level_ready = QtCore.pyqtSignal(int)
+
+    def __init__(self, image, max_level, max_bytes=512*1024*1024):
+        super().__init__()
+        self.max_level = max_level
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.levels = {1: image}
+        self.bytes_used = image.sizeInBytes()
+
+    def level_size(self, level):
+        image = self.levels[1]
+        w = max(1, round(image.width()/level))
+        h = max(1, round(image.height()*w/image.width()))
+        return (w, h)
+
+    def closest(self, level):
+        """Return the built level nearest to level that is not smaller
+        than it as (level, image)."""
+        with self.lock:
+            while level not in self.levels:
+                level -= 1
+            return (level, self.levels[level])
+
+    def memory_usage(self):
+        with self.lock:
+            return self.bytes_used
+
+    def run(self):
+        previous = self.levels[1]
+        for level in range(2, self.max_level + 1):
+            if self.isInterruptionRequested():
+                return
+            (w, h) = self.level_size(level)
+            scaled = previous.scaled(w, h)
+            with self.lock:
+                if self.bytes_used + scaled.sizeInBytes() > self.max_bytes:
+                    return
+                self.levels[level] = scaled
+                self.bytes_used += scaled.sizeInBytes()
+            self.level_ready.emit(level)
+            previous = scaled
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
 
 class SelectionArea(QtWidgets.QWidget):
-    def __init__(self, image, master_widget, parent = None):
+    segmentation_finished = QtCore.pyqtSignal(bool)
+
+    def __init__(self, image, master_widget, segmentation='whitespace', rects=None,
+                 noise=no_filter, parent = None):
         super().__init__(parent)
         self.master = master_widget
         self.original_image = image
+        self.bitmap = bitmap_from_qimage(image)
+        self.pyramid = ZoomPyramid(image, max_zoom)
+        self.pyramid.level_ready.connect(self.level_ready)
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.pyramid.stop)
         self.set_zoom(1)
+        self.pyramid.start()
 
-        strips = calculate_horizontal_sums(self.image, True)
-        hor_lines = calculate_cutlines_locations(strips)
-        self.boxes = calculate_letter_boxes(self.image, hor_lines)
         self.active_box = None
-
+        # Measurements shown by the debug overlay.
+        self.paint_seconds = 0.0
+        self.painted_boxes = 0
+        self.painted_area = (0, 0)
+        self.hit_test_seconds = 0.0
         self.selected_brush = QtGui.QBrush(QtGui.QColor(0, 0, 0, 127))
         self.active_brush = QtGui.QBrush(QtGui.QColor(255, 0, 0, 127))
 
+        self.worker = None
+        if rects is not None:
+            self.boxes = rects_to_boxes(rects)
+            self.index = BoxIndex(self.boxes)
+        else:
+            self.boxes = []
+            self.index = BoxIndex([])
+            self.start_segmentation(segmentation, noise)
+
+    def start_segmentation(self, segmentation, noise=no_filter):
+        self.progress_dialog = QtWidgets.QProgressDialog("Finding letters", "Cancel", 0, 0, self)
+        self.progress_dialog.setWindowModality(QtCore.Qt.NonModal)
+        self.progress_dialog.setMinimumDuration(500)
+        self.worker = SegmentationWorker(self.bitmap, segmentation, noise)
+        self.worker.rects_found.connect(self.add_rects)
+        self.worker.progress.connect(self.segmentation_progress)
+        self.worker.finished.connect(self.segmentation_done)
+        self.progress_dialog.canceled.connect(self.worker.requestInterruption)
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.worker.stop)
+        self.worker.start()
+
+    def is_segmenting(self):
+        return self.worker is not None
+
+    def add_rects(self, rects):
+        boxes = rects_to_boxes(rects)
+        self.boxes += boxes
+        self.index.add(boxes)
+        for box in boxes:
+            self.update_box(box)
+
+    def segmentation_progress(self, done, total):
+        self.progress_dialog.setMaximum(total)
+        self.progress_dialog.setValue(done)
+
+    def segmentation_done(self):
+        completed = self.worker.completed
+        self.worker = None
+        self.progress_dialog.reset()
+        self.progress_dialog.hide()
+        self.segmentation_finished.emit(completed)
+
     def set_zoom(self, value):
         self.zoom = value
         self.build_zoom_image()
-        self.resize(self.image.width(), self.image.height())
+        self.resize(*self.pyramid.level_size(value))
+        self.update()
 
     def build_zoom_image(self):
-        if self.zoom == 1:
-            self.image = self.original_image
-        else:
-            w = self.original_image.width()
-            self.image = self.original_image.scaledToWidth(round(w/self.zoom))
+        # Until the requested level is ready a more detailed
+        # one is shown scaled down when painting.
+        (self.image_level, self.image) = self.pyramid.closest(self.zoom)
+        self.pixmap = QtGui.QPixmap.fromImage(self.image)
+
+    def level_ready(self, level):
+        if level == self.zoom and self.image_level != level:
+            self.build_zoom_image()
+            self.update()
 
     def paintEvent(self, event):
+        start = time.perf_counter()
+        exposed = event.rect()
         paint = QtGui.QPainter()
         paint.begin(self)
-        paint.drawImage(0, 0, self.image)
+        if self.image_level == self.zoom:
+            paint.drawPixmap(exposed, self.pixmap, exposed)
+        else:
+            ratio = self.zoom/self.image_level
+            source = QtCore.QRectF(exposed.x()*ratio, exposed.y()*ratio,
+                                   exposed.width()*ratio, exposed.height()*ratio)
+            paint.drawPixmap(QtCore.QRectF(exposed), self.pixmap, source)
         pen = QtGui.QPen(QtCore.Qt.black, 1, QtCore.Qt.SolidLine)
         paint.setPen(pen)
-        for box in self.boxes:
+        boxes = self.boxes_in(exposed)
+        for box in boxes:
             zoomed_box = self.scale_box(box.r)
             paint.drawRect(zoomed_box)
             if box is self.active_box:
@@ -148,27 +230,46 @@ class SelectionArea(QtWidgets.QWidget):
             elif box.taken:
                 paint.fillRect(zoomed_box, self.selected_brush)
         paint.end()
+        self.paint_seconds = time.perf_counter() - start
+        self.painted_boxes = len(boxes)
+        self.painted_area = (exposed.width(), exposed.height())
+        profile.add_time('gui.paint', self.paint_seconds)
 
     def scale_box(self, box):
-        size = box.size()
-        p = box.topLeft()
-        scaled_size = QtCore.QSize(int(size.width()/self.zoom), int(size.height()/self.zoom))
-        scaled_p = QtCore.QPoint(int(p.x()/self.zoom), int(p.y()/self.zoom))
-        return QtCore.QRect(scaled_p, scaled_size)
+        return QtCore.QRect(int(box.x()/self.zoom), int(box.y()/self.zoom),
+                            int(box.width()/self.zoom), int(box.height()/self.zoom))
 
     def find_box(self, unscaled_x, unscaled_y):
+        start = time.perf_counter()
         x = unscaled_x*self.zoom
         y = unscaled_y*self.zoom
-        for b in self.boxes:
-            if b.contains(x, y):
-                return b
-        return None
+        box = self.index.find(x, y)
+        self.hit_test_seconds = time.perf_counter() - start
+        profile.add_time('gui.hit_test', self.hit_test_seconds)
+        return box
+
+    def boxes_in(self, rect):
+        """Boxes that intersect rect given in widget coordinates."""
+        # Scaled boxes are rounded down, so look one pixel further.
+        z = self.zoom
+        return self.index.query((rect.x() - 1)*z, (rect.y() - 1)*z,
+                                (rect.width() + 2)*z, (rect.height() + 2)*z)
+
+    def update_box(self, box):
+        if box is not None:
+            # The outline is drawn one pixel past the rectangle.
+            self.update(self.scale_box(box.r).adjusted(0, 0, 1, 1))
 
     def set_active_box(self, box):
+        if box is self.active_box:
+            return
+        self.update_box(self.active_box)
         self.active_box = box
+        self.update_box(box)
 
-    def take_box(self, box):
-        box.taken = True
+    def assignment_changed(self, glyph, old_box, new_box):
+        self.update_box(old_box)
+        self.update_box(new_box)
 
     def mousePressEvent(self, me):
         # I could not figure out how to connect
@@ -185,11 +286,17 @@ class StartDialog(QtWidgets.QWidget):
         self.name_edit = QtWidgets.QLineEdit('MyFont')
         self.file_edit = QtWidgets.QLineEdit()
         self.output_edit = QtWidgets.QLineEdit()
+        self.project_edit = QtWidgets.QLineEdit()
         if initial_file_name is not None:
             self.file_edit.setText(initial_file_name)
             self.set_output_file_from_source(initial_file_name)
         self.file_button = QtWidgets.QPushButton('Browse')
         self.file_button.clicked.connect(self.open_file)
+        self.segmentation_combo = QtWidgets.QComboBox()
+        for (label, mode) in segmentation_modes:
+            self.segmentation_combo.addItem(label, mode)
+        self.segmentation_combo.currentIndexChanged.connect(self.segmentation_changed)
+        self.build_noise_controls()
 
         self.grid.setSpacing(10)
         self.grid.addWidget(QtWidgets.QLabel('Font name'), 0, 0)
@@ -199,6 +306,12 @@ class StartDialog(QtWidgets.QWidget):
         self.grid.addWidget(self.file_button, 1, 2)
         self.grid.addWidget(QtWidgets.QLabel('Output file'), 2, 0)
         self.grid.addWidget(self.output_edit, 2, 1, 1, 2)
+        self.grid.addWidget(QtWidgets.QLabel('Project file'), 3, 0)
+        self.grid.addWidget(self.project_edit, 3, 1, 1, 2)
+        self.grid.addWidget(QtWidgets.QLabel('Segmentation'), 4, 0)
+        self.grid.addWidget(self.segmentation_combo, 4, 1, 1, 2)
+        self.grid.addWidget(QtWidgets.QLabel('Noise filter'), 5, 0)
+        self.grid.addWidget(self.noise_controls, 5, 1, 1, 2)
 
         hbox = QtWidgets.QHBoxLayout()
         about_button = QtWidgets.QPushButton('About')
@@ -212,10 +325,43 @@ class StartDialog(QtWidgets.QWidget):
         hbox.addWidget(quit_button)
         w = QtWidgets.QWidget()
         w.setLayout(hbox)
-        self.grid.addWidget(w, 3, 0, 1, 3)
+        self.grid.addWidget(w, 6, 0, 1, 3)
 
         self.setLayout(self.grid)
 
+    def build_noise_controls(self):
+        """Spin boxes for the NoiseFilter settings, the defaults do no
+        filtering."""
+        hbox = QtWidgets.QHBoxLayout()
+        hbox.setContentsMargins(0, 0, 0, 0)
+        self.noise_spins = []
+        defaults = no_filter.to_json()
+        for (key, prefix, minimum, maximum, tip) in [
+                ('min_ink', 'Ink: ', 1, 10000,
+                 'Black pixels a row or column needs to be part of a letter'),
+                ('min_strip', 'Strip: ', 1, 10000,
+                 'Rows and columns of ink narrower than this are ignored'),
+                ('min_gap', 'Gap: ', 1, 10000,
+                 'White space narrower than this does not separate letters'),
+                ('despeckle', 'Despeckle: ', 0, 8,
+                 'Black pixels with fewer black neighbours than this are ignored')]:
+            spin = QtWidgets.QSpinBox()
+            spin.setRange(minimum, maximum)
+            spin.setValue(defaults[key])
+            spin.setPrefix(prefix)
+            spin.setToolTip(tip)
+            hbox.addWidget(spin)
+            self.noise_spins.append(spin)
+        self.noise_controls = QtWidgets.QWidget()
+        self.noise_controls.setLayout(hbox)
+
+    def segmentation_changed(self, i):
+        # The filter only applies to white space segmentation.
+        self.noise_controls.setEnabled(self.segmentation_combo.currentData() == 'whitespace')
+
+    def noise_filter(self):
+        return NoiseFilter(*[spin.value() for spin in self.noise_spins])
+
     def quit_app(self):
         global app
         app.quit()
@@ -230,8 +376,8 @@ class StartDialog(QtWidgets.QWidget):
         parts = str(name).split('.')
         if len(parts) > 1:
             parts = parts[:-1]
-        parts.append('sfd')
-        self.output_edit.setText('.'.join(parts))
+        self.output_edit.setText('.'.join(parts + ['sfd']))
+        self.project_edit.setText('.'.join(parts + ['gtproject']))
 
     def about_message(self):
         QtWidgets.QMessageBox.information(self, "About " + program_name,
@@ -255,6 +401,8 @@ class StartDialog(QtWidgets.QWidget):
         fname = self.file_edit.text()
         output = self.output_edit.text()
         font_name = self.name_edit.text()
+        segmentation = self.segmentation_combo.currentData()
+        project_file = self.project_edit.text()
         image = QtGui.QImage(fname)
         if not self.is_image_file_valid(image):
             QtWidgets.QMessageBox.critical(self,
@@ -273,26 +421,30 @@ class StartDialog(QtWidgets.QWidget):
                                               QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No) == QtWidgets.QMessageBox.No:
                 return
         start_dialog.hide()
-        main_win = EditorWindow(image, font_name, output)
+        main_win = EditorWindow(image, font_name, output, segmentation, project_file,
+                                self.noise_filter())
         main_win.show()
 
 class EditorWindow(QtWidgets.QWidget):
-    def __init__(self, image, font_name, sfd_file, parent=None):
+    def __init__(self, image, font_name, sfd_file, segmentation='whitespace', project_file=None,
+                 noise=no_filter, parent=None):
         super().__init__()
         self.active_glyph = 0
         self.glyphlist = []
         self.font_name = font_name
         self.sfd_file = sfd_file
+        self.trace_cache = TraceCache()
 
         self.set_nice_windowsize(image)
 
         self.setWindowTitle(program_name + ': ' + font_name)
 
         self.grid = QtWidgets.QGridLayout()
-        self.area = SelectionArea(image, self)
+        self.open_project(image, segmentation, project_file, noise)
         sa = QtWidgets.QScrollArea()
         sa.setWidget(self.area)
         self.grid.addWidget(sa, 0, 0, 1, 6)
+        self.build_debug_overlay(sa.viewport())
 
         b = QtWidgets.QPushButton('Previous glyph')
         b.clicked.connect(self.previous_button)
@@ -314,7 +466,7 @@ class EditorWindow(QtWidgets.QWidget):
         self.grid.addWidget(self.combo, 1, 0, 1, 1)
 
         self.zoomlevel = QtWidgets.QSpinBox()
-        self.zoomlevel.setMaximum(5)
+        self.zoomlevel.setMaximum(max_zoom)
         self.zoomlevel.setMinimum(1)
         self.zoomlevel.setSingleStep(1)
         self.zoomlevel.setPrefix('Zoom level: ')
@@ -323,6 +475,91 @@ class EditorWindow(QtWidgets.QWidget):
 
         self.setLayout(self.grid)
 
+    def build_debug_overlay(self, parent):
+        """Label with painting and hit test timings, toggled with F12.
+        It stays in the corner of the view while the image scrolls."""
+        self.debug_overlay = QtWidgets.QLabel(parent)
+        self.debug_overlay.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+        # An opaque label is repainted without repainting the image under it.
+        self.debug_overlay.setAutoFillBackground(True)
+        self.debug_overlay.setStyleSheet('QLabel { background: #ffffe0; color: black; padding: 4px; }')
+        self.debug_overlay.move(4, 4)
+        self.debug_overlay.hide()
+        self.debug_timer = QtCore.QTimer(self)
+        self.debug_timer.setInterval(250)
+        self.debug_timer.timeout.connect(self.update_debug_overlay)
+
+    def toggle_debug_overlay(self):
+        if self.debug_overlay.isVisible():
+            self.debug_timer.stop()
+            self.debug_overlay.hide()
+        else:
+            self.update_debug_overlay()
+            self.debug_overlay.show()
+            self.debug_overlay.raise_()
+            self.debug_timer.start()
+
+    def update_debug_overlay(self):
+        a = self.area
+        self.debug_overlay.setText('Paint: %.2f ms, %d boxes, %dx%d pixels\n'
+                                   'Hit test: %.3f ms\n'
+                                   'Boxes: %d, zoom level %d' %
+                                   (a.paint_seconds*1000, a.painted_boxes,
+                                    a.painted_area[0], a.painted_area[1],
+                                    a.hit_test_seconds*1000, len(a.boxes), a.zoom))
+        self.debug_overlay.adjustSize()
+
+    def open_project(self, image, segmentation, project_file, noise=no_filter):
+        """Create the selection area and assignments, restoring them
+        from the project file if it was saved for this image."""
+        saved = None
+        self.project = None
+        self.segmentation = segmentation
+        self.noise = noise
+        if project_file:
+            self.project = ProjectFile(project_file)
+            self.image_hash = bitmap_from_qimage(image).digest()
+            saved = self.project.load(self.image_hash, segmentation, noise)
+        if saved is None:
+            self.area = SelectionArea(image, self, segmentation, noise=noise)
+        else:
+            self.area = SelectionArea(image, self, segmentation, saved[0])
+        self.assignments = GlyphAssignments()
+        if saved is not None:
+            for (name, codepoint, box_number) in saved[1]:
+                self.assignments.assign(self.assignments.glyph(name, codepoint),
+                                        self.area.boxes[box_number])
+        self.assignments.subscribe(self.area.assignment_changed)
+        if self.area.is_segmenting():
+            # Box numbers are only known when all boxes have been found.
+            self.area.segmentation_finished.connect(self.segmentation_finished)
+        else:
+            self.start_project()
+
+    def segmentation_finished(self, completed):
+        if completed:
+            self.start_project()
+        else:
+            self.project = None
+
+    def start_project(self):
+        if self.project is None:
+            return
+        try:
+            self.project.start(self.image_hash, self.segmentation, self.area.boxes,
+                               self.assignments.assigned(), self.noise)
+        except OSError as e:
+            QtWidgets.QMessageBox.warning(self, "Warning",
+                                          "Could not write project file, assignments will not be saved:\n" + str(e))
+            self.project = None
+            return
+        self.assignments.subscribe(self.project.record)
+
+    def closeEvent(self, event):
+        if self.project is not None:
+            self.project.close()
+        super().closeEvent(event)
+
     def set_nice_windowsize(self, image):
         global app
         w = image.width()
@@ -336,9 +573,7 @@ class EditorWindow(QtWidgets.QWidget):
         self.resize(final_width, final_height)
 
     def build_glyph_combo(self):
-        self.groups = {}
         for name, glyphs in glyph_groups:
-            self.groups[name] = [data_to_glyphinfo(x) for x in glyphs]
             self.combo.addItem(name)
         self.glyph_set_changed(0)
 
@@ -346,15 +581,13 @@ class EditorWindow(QtWidgets.QWidget):
         (x, y) = (mouse_event.x(), mouse_event.y())
         newbox = self.area.find_box(x, y)
         if newbox:
-            self.unselect(newbox)
-            self.area.take_box(newbox)
-            oldbox = self.glyphlist[self.active_glyph].box
-            if oldbox is not None:
-                oldbox.taken = False
-            self.glyphlist[self.active_glyph].box = newbox
+            self.assignments.assign(self.glyphlist[self.active_glyph], newbox)
             self.go_to_next_glyph()
 
     def keyPressEvent(self, key_event):
+        if key_event.key() == QtCore.Qt.Key_F12:
+            self.toggle_debug_overlay()
+            return
         if key_event.key() == QtCore.Qt.Key_Space:
             forward = True
         else:
@@ -378,17 +611,15 @@ class EditorWindow(QtWidgets.QWidget):
 
     def glyph_set_changed(self, i):
         self.active_glyph = 0
-        self.glyphlist = self.groups[str(self.combo.currentText())]
+        self.glyphlist = self.assignments.group(str(self.combo.currentText()))
         self.glyph_info_changed()
 
     def glyph_info_changed(self):
         self.set_glyph_info()
         self.area.set_active_box(self.glyphlist[self.active_glyph].box)
-        self.area.repaint()
 
     def zoom_changed(self, value):
         self.area.set_zoom(value)
-        self.area.repaint()
 
     def set_glyph_info(self):
         g = self.glyphlist[self.active_glyph]
@@ -396,27 +627,14 @@ class EditorWindow(QtWidgets.QWidget):
         (self.active_glyph+1, len(self.glyphlist), g.name, chr(g.codepoint))
         self.glyph_text.setText(info_text)
 
-    def unselect(self, box):
-        box.taken = False
-        for name in self.groups.keys():
-            for g in self.groups[name]:
-                if g.box is box:
-                    g.box = None
-                    return
-
-    def get_selected_glyphs(self):
-        selected = []
-        for name in self.groups.keys():
-            selected += filter(lambda x: x.box is not None, self.groups[name])
-        return selected
-
     def generate_sfd(self):
-        selected = self.get_selected_glyphs()
+        selected = self.assignments.assigned()
         if len(selected) == 0:
             QtWidgets.QMessageBox.critical(self, "Error", "No glyphs selected, can not generate sfd file.\n")
             return
         try:
-            write_sfd(self.sfd_file, self.font_name, self.area.image, selected)
+            update_sfd(self.sfd_file, self.font_name, self.area.bitmap, selected,
+                       cache=self.trace_cache)
         except Exception as e:
             QtWidgets.QMessageBox.critical(self, "Error", "Sfd generation failed:\n" + str(e))
             return
@@ -425,17 +643,29 @@ class EditorWindow(QtWidgets.QWidget):
 
 def start_program(arguments):
     global start_dialog, app
+    profile_file = gtprofile.profile_file_from_environment()
+    profile.enable(profile_file is not None)
     app = QtWidgets.QApplication(arguments)
-    if not i_haz_potrace():
-        QtWidgets.QMessageBox.critical(None, program_name, "Potrace executable not in path, exiting.")
-        sys.exit(127)
     if len(arguments) > 1:
         start_dialog = StartDialog(arguments[1])
     else:
         start_dialog = StartDialog()
     start_dialog.setWindowTitle(program_name)
     start_dialog.show()
-    sys.exit(app.exec_())
+    # Look for potrace only after the window is up.
+    QtCore.QTimer.singleShot(0, check_potrace)
+    result = app.exec_()
+    if profile_file is not None:
+        gtprofile.write_report(profile_file, profile.report())
+    sys.exit(result)
+
+def check_potrace():
+    try:
+        find_tracer()
+    except RuntimeError:
+        QtWidgets.QMessageBox.critical(None, program_name,
+                                       "Neither the Potrace executable nor the pypotrace module was found, exiting.")
+        app.exit(127)
 
 def test_edwin():
     global app
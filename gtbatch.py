@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Headless batch processing of glyph sheets.
+
+import os, sys, argparse
+import concurrent.futures
+from gtlib import *
+from gtcache import TraceCache
+import gtprofile
+
+# The mapping file tells which glyph each box is, in the order
+# the boxes are found on the sheet. Every line is one of:
+#
+#   latin lower case    a glyph group, assigns one box per glyph
+#   eacute              a single glyph by its name
+#   afii10073 1080      a glyph name with an explicit code point
+#   -                   skips one box
+#
+# Empty lines and lines starting with # are ignored.
+
+def parse_mapping(lines):
+    groups = dict(glyph_groups)
+    by_name = {}
+    for (_, glyphs) in glyph_groups:
+        for (name, codepoint) in glyphs:
+            by_name.setdefault(name, codepoint)
+    entries = []
+    for (lineno, line) in enumerate(lines, 1):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        if line == '-':
+            entries.append(None)
+        elif line in groups:
+            entries += groups[line]
+        else:
+            parts = line.split()
+            if len(parts) == 2 and parts[1].isdigit():
+                entries.append((parts[0], int(parts[1])))
+            elif len(parts) == 1 and parts[0] in by_name:
+                entries.append((parts[0], by_name[parts[0]]))
+            else:
+                raise RuntimeError('Line %d: unknown glyph or group: %s' % (lineno, line))
+    return entries
+
+def load_mapping(fname):
+    with open(fname, 'r') as f:
+        return parse_mapping(f)
+
+def assign_glyphs(boxes, entries, allow_mismatch=False):
+    """Pair boxes with the mapping entries in order. The counts must
+    agree unless allow_mismatch is set, then the extra boxes or
+    entries are left out."""
+    if len(boxes) != len(entries) and not allow_mismatch:
+        raise RuntimeError('%d letter boxes found but the mapping has %d entries '
+                           '(use --allow-mismatch to trace them anyway)' % (len(boxes), len(entries)))
+    glyphs = []
+    for (box, entry) in zip(boxes, entries):
+        if entry is None:
+            continue
+        glyph = data_to_glyphinfo(entry)
+        glyph.box = box
+        glyphs.append(glyph)
+    return glyphs
+
+def output_name(sheet, outdir, extension='.sfd'):
+    base = os.path.splitext(sheet)[0]
+    if outdir is not None:
+        base = os.path.join(outdir, os.path.basename(base))
+    return base + extension
+
+def process_sheet(sheet, entries, ofilename, font_name, segmentation, jobs, cache_dir, incremental,
+                  band_bytes=None, tracer_name=None, whole_page=False, profiling=False, ufo=False, grid=None,
+                  precision=None, noise=None, allow_mismatch=False):
+    """noise is a dict of NoiseFilter settings. Returns the number of
+    boxes and glyphs, the profile report of the sheet or None, a
+    summary of the size reduction if the output was optimized with
+    grid, else None, and the trace cache statistics or None."""
+    # Imported here so that the main process starts quickly.
+    import gtsegment
+    profile = gtprofile.profile
+    profile.enable(profiling)
+    profile.reset()
+    if band_bytes is None:
+        band_bytes = gtsegment.default_band_bytes
+    bitmap = gtsegment.load_bitmap(sheet, band_bytes)
+    noise = gtsegment.NoiseFilter(**(noise or {}))
+    boxes = rects_to_boxes(gtsegment.segment(bitmap, segmentation, noise))
+    glyphs = assign_glyphs(boxes, entries, allow_mismatch)
+    if len(glyphs) == 0:
+        raise RuntimeError('No glyphs assigned')
+    cache = None
+    if cache_dir is not None:
+        cache = TraceCache(cache_dir)
+    tracer = find_tracer(tracer_name)
+    optimizer = None
+    if grid is not None:
+        optimizer = SfdOptimizer(grid)
+    with profile.timer('write'):
+        if ufo:
+            import gtufo
+            gtufo.write_ufo(ofilename, font_name, bitmap, glyphs, jobs, cache, tracer, whole_page)
+        elif incremental:
+            update_sfd(ofilename, font_name, bitmap, glyphs, jobs, cache, tracer, whole_page,
+                       precision)
+        else:
+            write_sfd(ofilename, font_name, bitmap, glyphs, jobs, cache, tracer, whole_page,
+                      optimizer, precision)
+    report = None
+    if profiling:
+        report = profile.report()
+    summary = None
+    if optimizer is not None:
+        summary = optimizer.summary()
+    stats = None
+    if cache is not None and not whole_page:
+        stats = cache.stats()
+    return (len(boxes), len(glyphs), report, summary, stats)
+
+def main(arguments):
+    parser = argparse.ArgumentParser(prog='glyphtracer batch',
+                                     description='Convert glyph sheets to SFD files without a GUI.')
+    parser.add_argument('mapping', help='file mapping boxes to glyphs')
+    parser.add_argument('sheets', nargs='+', help='1 bit images of glyphs')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='directory for the fonts (default: next to the images)')
+    parser.add_argument('-n', '--font-name', default=None,
+                        help='font name (default: image file name)')
+    parser.add_argument('-s', '--segmentation', default='whitespace',
+                        choices=[m for (_, m) in segmentation_modes])
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs(),
+                        help='number of parallel workers')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only retrace glyphs that changed since the previous run')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the trace cache')
+    parser.add_argument('-t', '--tracer', default=None, choices=[t.name for t in tracers],
+                        help='tracing backend (default: the first one available of %s)'
+                        % ', '.join([t.name for t in tracers]))
+    parser.add_argument('--whole-page', action='store_true',
+                        help='run potrace once per sheet (or job) instead of once per glyph')
+    parser.add_argument('--allow-mismatch', action='store_true',
+                        help='trace the sheet even if the number of boxes and mapping entries differ')
+    parser.add_argument('--band-size', type=int, default=None, metavar='MB',
+                        help='memory used for each band of rows of a sheet')
+    parser.add_argument('--min-ink', type=int, default=1, metavar='PIXELS',
+                        help='black pixels a row or column needs to be part of a letter (default: 1)')
+    parser.add_argument('--min-strip', type=int, default=1, metavar='PIXELS',
+                        help='ignore rows and columns of ink narrower than this (default: 1)')
+    parser.add_argument('--min-gap', type=int, default=1, metavar='PIXELS',
+                        help='white space narrower than this does not separate letters (default: 1)')
+    parser.add_argument('--despeckle', type=int, default=0, metavar='NEIGHBOURS',
+                        help='ignore black pixels with fewer black neighbours than this '
+                        'when looking for white space (default: 0, off)')
+    parser.add_argument('--ufo', action='store_true',
+                        help='write UFO fonts instead of SFD files')
+    parser.add_argument('--optimize', action='store_true',
+                        help='write smaller SFD files: round coordinates to the grid, '
+                        'simplify the curves and write identical glyphs as references')
+    parser.add_argument('--grid', type=float, default=1.0, metavar='UNITS',
+                        help='grid of --optimize in font units (default: 1)')
+    parser.add_argument('--precision', type=int, default=None, metavar='DIGITS',
+                        help='round coordinates to DIGITS decimals (default: full precision)')
+    parser.add_argument('--profile', default=gtprofile.profile_file_from_environment(),
+                        metavar='FILE',
+                        help='write the time spent in each stage and on each glyph to FILE as JSON '
+                        '(default: $%s)' % gtprofile.profile_variable)
+    options = parser.parse_args(arguments)
+    if options.ufo and options.incremental:
+        parser.error('--incremental only works with SFD files')
+    if options.optimize and (options.ufo or options.incremental):
+        parser.error('--optimize does not work with --ufo or --incremental')
+    if options.precision is not None and (options.optimize or options.ufo):
+        parser.error('--precision does not work with --optimize or --ufo')
+    if not 0 <= options.despeckle <= 8:
+        parser.error('--despeckle must be between 0 and 8')
+    if options.grid <= 0:
+        parser.error('--grid must be positive')
+
+    try:
+        entries = load_mapping(options.mapping)
+    except (OSError, RuntimeError) as e:
+        print('%s: %s' % (options.mapping, e), file=sys.stderr)
+        return 1
+    if options.output_dir is not None:
+        os.makedirs(options.output_dir, exist_ok=True)
+    cache_dir = None if options.no_cache else TraceCache().directory
+    noise = {'min_ink': options.min_ink,
+             'min_strip': options.min_strip,
+             'min_gap': options.min_gap,
+             'despeckle': options.despeckle}
+    band_bytes = None
+    if options.band_size is not None:
+        band_bytes = max(1, options.band_size)*1024*1024
+    # Sheets are independent so they go to separate processes,
+    # the remaining cores are used for tracing within a sheet.
+    processes = max(1, min(options.jobs, len(options.sheets)))
+    trace_jobs = max(1, options.jobs // processes)
+    failures = 0
+    reports = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = []
+        for sheet in options.sheets:
+            ofilename = output_name(sheet, options.output_dir, '.ufo' if options.ufo else '.sfd')
+            font_name = options.font_name
+            if font_name is None:
+                font_name = os.path.splitext(os.path.basename(sheet))[0]
+            futures.append((sheet, ofilename,
+                            executor.submit(process_sheet, sheet, entries, ofilename, font_name,
+                                            options.segmentation, trace_jobs, cache_dir,
+                                            options.incremental, band_bytes, options.tracer,
+                                            options.whole_page, options.profile is not None,
+                                            options.ufo, options.grid if options.optimize else None,
+                                            options.precision, noise, options.allow_mismatch)))
+        for (sheet, ofilename, future) in futures:
+            try:
+                (num_boxes, num_glyphs, report, summary, stats) = future.result()
+            except Exception as e:
+                print('%s: %s' % (sheet, e), file=sys.stderr)
+                failures += 1
+                continue
+            if report is not None:
+                reports[sheet] = report
+            print('%s: %d boxes, %d glyphs -> %s' % (sheet, num_boxes, num_glyphs, ofilename))
+            if summary is not None:
+                print('%s: %s' % (ofilename, summary))
+            if stats is not None:
+                print('%s: trace cache %d hits, %d misses, %d evictions'
+                      % (sheet, stats['hits'], stats['misses'], stats['evictions']))
+    if options.profile is not None:
+        gtprofile.write_report(options.profile, {'format': gtprofile.profile_format,
+                                                 'version': gtprofile.profile_version,
+                                                 'sheets': reports})
+    return 1 if failures > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
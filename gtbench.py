@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks of the processing stages on synthetic glyph sheets.
+
+import os, sys, io, json, time, argparse, platform, tempfile, tracemalloc
+import numpy
+from gtlib import *
+import gtsegment
+
+# Differences smaller than this are treated as measurement noise
+# when comparing against a baseline.
+noise_seconds = 0.002
+
+# Glyphs take this share of the width and height of their grid cell,
+# the rest is white space between them.
+glyph_fill = 0.6
+
+def glyph_shape(rng, size):
+    """Draw a random letter like shape of strokes and rings."""
+    (yy, xx) = numpy.mgrid[0:size, 0:size] + 0.5
+    stroke = max(2.0, size/8.0)
+    margin = stroke/2
+    shape = numpy.zeros((size, size), dtype=bool)
+    for i in range(rng.integers(2, 5)):
+        if rng.random() < 0.3:
+            r = rng.uniform(size/6.0, size/2.0 - margin)
+            (cx, cy) = rng.uniform(r + margin, size - r - margin, 2)
+            shape |= numpy.abs(numpy.hypot(xx - cx, yy - cy) - r) < stroke/2
+        else:
+            (x0, y0, x1, y1) = rng.uniform(margin, size - margin, 4)
+            (dx, dy) = (x1 - x0, y1 - y0)
+            t = ((xx - x0)*dx + (yy - y0)*dy)/max(dx*dx + dy*dy, 1e-9)
+            t = numpy.clip(t, 0, 1)
+            shape |= numpy.hypot(xx - x0 - t*dx, yy - y0 - t*dy) < stroke/2
+    return shape
+
+def generate_sheet(glyphs, dpi, density, seed=0):
+    """Generate a sheet of random glyphs on a grid.
+
+    density is the number of glyphs per square inch, it sets the
+    size of the glyphs. Returns the pixels, 1 is black. The same
+    arguments always give the same sheet."""
+    rng = numpy.random.default_rng(seed)
+    cell = max(8, int(round(dpi/density**0.5)))
+    size = max(4, int(cell*glyph_fill))
+    columns = max(1, int(round(glyphs**0.5)))
+    rows = (glyphs + columns - 1)//columns
+    pixels = numpy.zeros((rows*cell, columns*cell), dtype=numpy.uint8)
+    offset = (cell - size)//2
+    for i in range(glyphs):
+        (row, column) = divmod(i, columns)
+        y = row*cell + offset
+        x = column*cell + offset
+        pixels[y:y+size, x:x+size] = glyph_shape(rng, size)
+    return pixels
+
+class Stage(object):
+    def __init__(self, name, seconds, items, unit, peak_bytes):
+        self.name = name
+        self.seconds = seconds
+        self.items = items
+        self.unit = unit
+        self.peak_bytes = peak_bytes
+
+    def throughput(self):
+        if self.seconds <= 0:
+            return None
+        return self.items/self.seconds
+
+    def to_json(self):
+        return {'seconds': self.seconds,
+                'items': self.items,
+                'unit': self.unit,
+                'throughput': self.throughput(),
+                'peak_bytes': self.peak_bytes}
+
+def measure(function, repeat, memory):
+    """Run function repeat times. Returns the result, the fastest
+    time and the peak memory allocated during an extra run."""
+    times = []
+    for i in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return (result, min(times), peak)
+
+def fontforge_load(fname):
+    import fontforge
+    fontforge.open(fname).close()
+
+def has_fontforge():
+    try:
+        import fontforge
+    except ImportError:
+        return False
+    return True
+
+def run_benchmark(options):
+    stages = []
+    sizes = {}
+    def stage(name, function, items, unit):
+        (result, seconds, peak) = measure(function, options.repeat, not options.no_memory)
+        stages.append(Stage(name, seconds, items, unit, peak))
+        return result
+
+    pixels = generate_sheet(options.glyphs, options.dpi, options.density, options.seed)
+    (h, w) = pixels.shape
+    megapixels = w*h/1e6
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sheet = os.path.join(tmpdir, 'sheet.pbm')
+        with open(sheet, 'wb') as f:
+            f.write(gtsegment.pixels_to_pbm(pixels))
+        bitmap = stage('load', lambda: gtsegment.load_bitmap(sheet), megapixels, 'Mpixel')
+        sums = stage('row_sums', lambda: bitmap.row_sums(), megapixels, 'Mpixel')
+        strips = stage('cutlines', lambda: gtsegment.calculate_cutlines_locations(sums),
+                       len(sums)/1e6, 'Mrow')
+        rects = stage('letter_boxes', lambda: gtsegment.letter_rects(bitmap, strips),
+                      megapixels, 'Mpixel')
+        if options.segmentation == 'components':
+            rects = stage('components', lambda: gtsegment.component_rects(bitmap),
+                          megapixels, 'Mpixel')
+        rects = [r for r in rects if r[2] > 0 and r[3] > 0]
+        boxes = rects_to_boxes(rects)
+        pbms = stage('crop', lambda: [bitmap.crop_pbm(*r) for r in rects], len(rects), 'glyph')
+
+        try:
+            tracer = find_tracer(options.tracer)
+        except RuntimeError as e:
+            tracer = None
+            print('Skipping tracing: %s' % e, file=sys.stderr)
+        if tracer is not None:
+            if tracer.name == 'program':
+                # Time potrace and the parsing of its output separately.
+                eps = stage('trace', lambda: [potrace_eps(p) for p in pbms], len(pbms), 'glyph')
+                paths = lambda: [eps_paths(e) for e in eps]
+            else:
+                traced = stage('trace', lambda: [tracer.trace_paths(p) for p in pbms],
+                               len(pbms), 'glyph')
+                paths = lambda: traced
+            curves = stage('convert', lambda: [paths_to_curves(*p) for p in paths()],
+                           len(pbms), 'glyph')
+            glyphs = []
+            for (i, box) in enumerate(boxes):
+                glyph = GlyphInfo('glyph%d' % i, 0xe000 + i)
+                glyph.box = box
+                glyphs.append(glyph)
+            def serialize():
+                buf = io.StringIO()
+                scale = calculate_scale(glyphs)
+                for (glyph, points) in zip(glyphs, curves):
+                    write_glyph(buf, glyph, points, scale)
+                return buf.getvalue()
+            stage('serialize', serialize, len(glyphs), 'glyph')
+            ofilename = os.path.join(tmpdir, 'bench.sfd')
+            stage('write_sfd', lambda: write_sfd(ofilename, 'Bench', bitmap, glyphs,
+                                                 options.jobs, None, tracer),
+                  len(glyphs), 'glyph')
+            optimized = os.path.join(tmpdir, 'bench-optimized.sfd')
+            stage('write_sfd_optimized',
+                  lambda: write_sfd(optimized, 'Bench', bitmap, glyphs, options.jobs, None, tracer,
+                                    optimizer=SfdOptimizer(options.grid)),
+                  len(glyphs), 'glyph')
+            sizes = {'sfd': os.path.getsize(ofilename),
+                     'sfd_optimized': os.path.getsize(optimized)}
+            if has_fontforge():
+                # How long FontForge takes to open the files.
+                stage('fontforge_load', lambda: fontforge_load(ofilename), len(glyphs), 'glyph')
+                stage('fontforge_load_optimized', lambda: fontforge_load(optimized),
+                      len(glyphs), 'glyph')
+    return {'parameters': {'glyphs': options.glyphs,
+                           'dpi': options.dpi,
+                           'density': options.density,
+                           'seed': options.seed,
+                           'segmentation': options.segmentation,
+                           'jobs': options.jobs,
+                           'grid': options.grid,
+                           'width': w,
+                           'height': h,
+                           'boxes': len(rects)},
+            'environment': {'python': platform.python_version(),
+                            'numpy': numpy.__version__,
+                            'machine': platform.machine(),
+                            'tracer': None if tracer is None else tracer.name},
+            'stages': dict([(s.name, s.to_json()) for s in stages]),
+            'sizes': sizes,
+            'order': [s.name for s in stages]}
+
+def format_bytes(n):
+    if n is None:
+        return '-'
+    return '%.1f MB' % (n/1e6)
+
+def print_report(report, baseline=None):
+    p = report['parameters']
+    print('%d glyphs at %d dpi: %dx%d pixels, %d boxes' %
+          (p['glyphs'], p['dpi'], p['width'], p['height'], p['boxes']))
+    header = '%-24s %10s %20s %12s' % ('stage', 'time (s)', 'throughput', 'peak memory')
+    if baseline is not None:
+        header += ' %10s' % 'vs base'
+    print(header)
+    for name in report['order']:
+        s = report['stages'][name]
+        throughput = '-'
+        if s['throughput'] is not None:
+            throughput = '%.1f %s/s' % (s['throughput'], s['unit'])
+        line = '%-24s %10.4f %20s %12s' % (name, s['seconds'], throughput,
+                                           format_bytes(s['peak_bytes']))
+        if baseline is not None and name in baseline['stages']:
+            base = baseline['stages'][name]['seconds']
+            if base > 0:
+                line += ' %9.2fx' % (s['seconds']/base)
+        print(line)
+    sizes = report.get('sizes', {})
+    if 'sfd' in sizes:
+        print('SFD size: %d bytes, optimized %d bytes' % (sizes['sfd'], sizes['sfd_optimized']))
+
+def regressions(report, baseline, tolerance):
+    """Names of the stages that are slower than in the baseline by
+    more than the tolerance."""
+    if report['parameters'] != baseline['parameters']:
+        print('Warning: the baseline was run with different parameters.', file=sys.stderr)
+    slower = []
+    for name in report['order']:
+        if name not in baseline['stages']:
+            continue
+        base = baseline['stages'][name]['seconds']
+        seconds = report['stages'][name]['seconds']
+        if seconds > base*(1 + tolerance) and seconds - base > noise_seconds:
+            slower.append(name)
+    return slower
+
+def main(arguments):
+    parser = argparse.ArgumentParser(prog='gtbench',
+                                     description='Time the processing stages on a synthetic glyph sheet.')
+    parser.add_argument('-g', '--glyphs', type=int, default=200, help='number of glyphs')
+    parser.add_argument('-d', '--dpi', type=int, default=300, help='resolution of the sheet')
+    parser.add_argument('--density', type=float, default=4.0,
+                        help='glyphs per square inch (default: 4)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the sheet')
+    parser.add_argument('-s', '--segmentation', default='whitespace',
+                        choices=[m for (_, m) in segmentation_modes])
+    parser.add_argument('-t', '--tracer', default=None, choices=[t.name for t in tracers])
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs(),
+                        help='parallel workers for write_sfd')
+    parser.add_argument('--grid', type=float, default=1.0,
+                        help='grid of the optimized SFD file in font units (default: 1)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs of every stage, the fastest one is reported')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory')
+    parser.add_argument('-o', '--output', default=None, help='write the results as JSON')
+    parser.add_argument('-b', '--baseline', default=None, help='compare against earlier JSON results')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown against the baseline (default: 0.1)')
+    options = parser.parse_args(arguments)
+
+    baseline = None
+    if options.baseline is not None:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+    report = run_benchmark(options)
+    print_report(report, baseline)
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if baseline is not None:
+        slower = regressions(report, baseline, options.tolerance)
+        if len(slower) > 0:
+            print('Slower than the baseline: %s' % ', '.join(slower))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# On disk cache of traced glyph contours.
+
+import os, json, hashlib, tempfile, threading
+
+default_cache_size = 256*1024*1024
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME', '')
+    if base == '':
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'glyphtracer', 'traces')
+
+class TraceCache(object):
+    """Content addressed store of traced contours.
+
+    Entries are keyed by a hash of the cropped bitmap and the
+    tracer arguments. When the total size grows over max_bytes the
+    least recently used entries are removed."""
+    def __init__(self, directory=None, max_bytes=default_cache_size):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, image_data, arguments):
+        h = hashlib.sha256()
+        h.update('\0'.join(arguments).encode('utf-8'))
+        h.update(b'\0')
+        h.update(image_data)
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'r') as f:
+                curves = json.load(f)
+            # The modification time tells how recently an entry was used.
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return curves
+
+    def put(self, key, curves):
+        path = self.entry_path(key)
+        data = json.dumps(curves, separators=(',', ':')).encode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fd, tempname) = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tempname, path)
+        except OSError:
+            os.unlink(tempname)
+            raise
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = self.disk_usage()
+            else:
+                self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        result = []
+        if not os.path.isdir(self.directory):
+            return result
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    result.append((st.st_mtime, st.st_size, entry.path))
+        return result
+
+    def disk_usage(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        # Shrink well below the limit so that eviction does
+        # not need to run again on the very next insertion.
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        target = self.max_bytes*0.9
+        for (_, size, path) in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self.total_bytes = total
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
@@ -18,7 +18,12 @@
 
 # Glyphtracer library files and stuff
 
-import os, subprocess, tempfile
+import os, stat, subprocess, re, io, json, hashlib, tempfile, functools, bisect, itertools, time
+import concurrent.futures
+from gtprofile import profile
+
+# NumPy is imported in the functions that need it, so that batch mode
+# starts without loading it.
 
 program_name = 'Glyphtracer'
 program_version = '2.1'
@@ -129,6 +134,10 @@ glyph_groups = [('latin lower case', latin_lowercase_list),\
                 ('cyrillic lowercase', cyrillic_lower),\
                 ('cyrillic uppercase', cyrillic_upper)]
 
+# Segmentation methods as (user visible name, mode) pairs.
+segmentation_modes = [('White space', 'whitespace'),\
+                      ('Connected components', 'components')]
+
 sfd_header = """SplineFontDB: 3.0
 FontName: %%s
 FullName: %%s
@@ -197,6 +206,14 @@ EndChar
 
 """
 
+# A glyph that is drawn as the glyph at the given position and code
+# point, without transformation.
+reference_footer = """EndSplineSet
+Refer: %d %d N 1 0 0 1 0 0 2
+EndChar
+
+"""
+
 # Numerical constants
 total_height = 2048 # By convention on Opentype Fonts
 ascent = 1638
@@ -204,8 +221,42 @@ descent= total_height - ascent
 height_ratio = 0.9
 highest_y_coordinate = height_ratio * ascent
 potrace_pixel_multiplier = 10
+potrace_arguments = ['-c', '--eps', '-q']
 rbearing = 150
 
+class Rect(object):
+    """An integer rectangle with the same accessors as QRect."""
+    def __init__(self, x, y, w, h):
+        self.rx = x
+        self.ry = y
+        self.w = w
+        self.h = h
+
+    def x(self):
+        return self.rx
+
+    def y(self):
+        return self.ry
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+    def contains(self, x, y):
+        return self.rx <= x < self.rx + self.w and self.ry <= y < self.ry + self.h
+
+    def __eq__(self, other):
+        return isinstance(other, Rect) and \
+            (self.rx, self.ry, self.w, self.h) == (other.rx, other.ry, other.w, other.h)
+
+    def __hash__(self):
+        return hash((self.rx, self.ry, self.w, self.h))
+
+    def __repr__(self):
+        return 'Rect(%d, %d, %d, %d)' % (self.rx, self.ry, self.w, self.h)
+
 class LetterBox(object):
     def __init__(self, rectangle):
         self.r = rectangle
@@ -214,155 +265,698 @@ class LetterBox(object):
     def contains(self, x, y):
         return self.r.contains(x, y)
 
+class BoxRow(object):
+    def __init__(self, boxes):
+        self.boxes = sorted(boxes, key=lambda b: b.r.x())
+        self.top = min(b.r.y() for b in boxes)
+        self.bottom = max(b.r.y() + b.r.height() for b in boxes)
+        self.xs = [b.r.x() for b in self.boxes]
+        self.max_width = max(b.r.width() for b in boxes)
+
+    def candidates(self, x0, x1):
+        """Boxes of this row that may overlap columns [x0, x1)."""
+        first = bisect.bisect_left(self.xs, x0 - self.max_width + 1)
+        last = bisect.bisect_left(self.xs, x1)
+        return self.boxes[first:last]
+
+class BoxIndex(object):
+    """Spatial index of letter boxes.
+
+    Boxes are grouped into rows whose vertical extents do not overlap,
+    sorted from top to bottom. Within a row the boxes are sorted by
+    x. Both levels are searched with bisection."""
+    def __init__(self, boxes):
+        self.boxes = []
+        self.rows = []
+        self.tops = []
+        self.bottoms = []
+        self.add(boxes)
+
+    def group_rows(self, boxes):
+        rows = []
+        row = []
+        bottom = None
+        for b in sorted(boxes, key=lambda b: b.r.y()):
+            if bottom is not None and b.r.y() >= bottom:
+                rows.append(BoxRow(row))
+                row = []
+            row.append(b)
+            bottom = max(bottom or 0, b.r.y() + b.r.height())
+        if len(row) > 0:
+            rows.append(BoxRow(row))
+        return rows
+
+    def add(self, boxes):
+        """Add boxes to the index. This is cheap when they are all
+        below the existing ones, otherwise the index is rebuilt."""
+        if len(boxes) == 0:
+            return
+        self.boxes += boxes
+        new_rows = self.group_rows(boxes)
+        if len(self.rows) > 0 and new_rows[0].top < self.bottoms[-1]:
+            new_rows = self.group_rows(self.boxes)
+            self.rows = []
+        self.rows += new_rows
+        self.tops = [r.top for r in self.rows]
+        self.bottoms = [r.bottom for r in self.rows]
+
+    def find(self, x, y):
+        """The box containing point (x, y) or None."""
+        i = bisect.bisect_right(self.tops, y) - 1
+        if i < 0 or y >= self.bottoms[i]:
+            return None
+        for b in self.rows[i].candidates(x, x + 1):
+            if b.contains(x, y):
+                return b
+        return None
+
+    def query(self, x, y, w, h):
+        """All boxes that intersect the given rectangle."""
+        result = []
+        first = bisect.bisect_right(self.bottoms, y)
+        last = bisect.bisect_left(self.tops, y + h)
+        for row in self.rows[first:last]:
+            for b in row.candidates(x, x + w):
+                r = b.r
+                if r.x() + r.width() > x and r.y() < y + h and r.y() + r.height() > y:
+                    result.append(b)
+        return result
+
 class GlyphInfo(object):
     def __init__(self, name, codepoint):
         self.name = name
         self.codepoint = codepoint
         self.box = None
 
+class GlyphAssignments(object):
+    """Keeps track of which letter box is assigned to which glyph.
+
+    GlyphInfo objects are created when their group is first needed.
+    Glyphs are indexed by code point and by their box, so assigning,
+    unassigning and listing the assigned glyphs do not need to look
+    through all groups. Listeners are called with (glyph, old box,
+    new box) whenever an assignment changes."""
+    def __init__(self, groups=glyph_groups):
+        self.group_entries = dict(groups)
+        self.group_glyphs = {}
+        self.position = {}
+        for (_, glyphs) in groups:
+            for (name, codepoint) in glyphs:
+                self.position.setdefault(codepoint, len(self.position))
+        self.by_codepoint = {}
+        self.by_box = {}
+        self.assigned_glyphs = {}
+        self.listeners = []
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def notify(self, glyph, old_box, new_box):
+        for callback in self.listeners:
+            callback(glyph, old_box, new_box)
+
+    def glyph(self, name, codepoint):
+        g = self.by_codepoint.get(codepoint)
+        if g is None:
+            g = GlyphInfo(name, codepoint)
+            self.by_codepoint[codepoint] = g
+        return g
+
+    def group(self, name):
+        glyphs = self.group_glyphs.get(name)
+        if glyphs is None:
+            glyphs = [self.glyph(*x) for x in self.group_entries[name]]
+            self.group_glyphs[name] = glyphs
+        return glyphs
+
+    def glyph_for_box(self, box):
+        return self.by_box.get(box)
+
+    def assign(self, glyph, box):
+        owner = self.by_box.get(box)
+        if owner is glyph:
+            return
+        if owner is not None:
+            self.unassign(owner)
+        old_box = glyph.box
+        if old_box is not None:
+            old_box.taken = False
+            del self.by_box[old_box]
+        glyph.box = box
+        box.taken = True
+        self.by_box[box] = glyph
+        self.assigned_glyphs[glyph.codepoint] = glyph
+        self.notify(glyph, old_box, box)
+
+    def unassign(self, glyph):
+        box = glyph.box
+        if box is None:
+            return
+        glyph.box = None
+        box.taken = False
+        del self.by_box[box]
+        del self.assigned_glyphs[glyph.codepoint]
+        self.notify(glyph, box, None)
+
+    def assigned(self):
+        """Assigned glyphs in the order of the glyph groups."""
+        return sorted(self.assigned_glyphs.values(),
+                      key=lambda g: self.position.get(g.codepoint, len(self.position)))
+
+    def __len__(self):
+        return len(self.assigned_glyphs)
+
+@functools.lru_cache(maxsize=None)
 def i_haz_potrace():
-    p = subprocess.Popen(['potrace', '-h'],
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         universal_newlines=True)
-    p.wait()
+    try:
+        p = subprocess.Popen(['potrace', '-h'],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    except OSError:
+        return False
+    p.communicate()
     return p.returncode == 0
 
 def data_to_glyphinfo(data):
     return GlyphInfo(data[0], data[1])
 
+def rects_to_boxes(rects):
+    return [LetterBox(Rect(*r)) for r in rects]
+
+
+# Contours are stored as two arrays: the kind of every segment and
+# its coordinates as a row of six integers. A curve uses the whole row
+# (two control points and the end point), a moveto or lineto only has
+# its point in the last two columns. A moveto starts a new closed path.
+segment_moveto = 0
+segment_lineto = 1
+segment_curveto = 2
+segment_closepath = 3
+
+# Name, segment kind and number of arguments of the commands in
+# potrace's output. A fill is emitted when there is more than one
+# blob in the image, that's ok.
+postscript_commands = [('moveto', segment_moveto, 2),
+                       ('rlineto', segment_lineto, 2),
+                       ('rcurveto', segment_curveto, 6),
+                       ('closepath', segment_closepath, 0),
+                       ('fill', None, 0)]
+
+postscript_command_index = dict((c[0], i) for (i, c) in enumerate(postscript_commands))
+
+# Translation tables that leave only the numbers or only the
+# command names of PostScript text.
+postscript_letters = ''.join(chr(c) for c in range(128) if chr(c).isalpha())
+postscript_numbers_only = str.maketrans(postscript_letters, ' '*len(postscript_letters))
+postscript_names_only = str.maketrans('0123456789-+', ' '*12)
 
-def integerise(command_line):
-    return [int(x) for x in command_line.split()[0:-1]]
+def split_postscript(commands):
+    """Split PostScript text into numbers and commands without
+    handling the tokens one by one in Python.
+
+    Returns (numbers, commands, nargs): the integer arguments, the
+    index of every command in postscript_commands and the number of
+    arguments it was given."""
+    import numpy
+    text = ' '.join(commands)
+    data = numpy.frombuffer(text.encode('ascii'), dtype=numpy.uint8)
+    is_space = data <= ord(' ')
+    starts = numpy.flatnonzero(~is_space & numpy.r_[True, is_space[:-1]])
+    # Commands start with a letter, the subtraction wraps other bytes
+    # around to large values.
+    is_command = ((data[starts] | 0x20) - ord('a')) < 26
+    positions = numpy.flatnonzero(is_command)
+    names = text.translate(postscript_names_only).split()
+    try:
+        numbers = numpy.fromstring(text.translate(postscript_numbers_only),
+                                   dtype=numpy.int64, sep=' ')
+    except ValueError:
+        numbers = None
+    if numbers is None or len(names) != len(positions) or \
+       len(numbers) != len(starts) - len(positions):
+        raise RuntimeError('Invalid number in PostScript')
+    found = numpy.fromiter(map(postscript_command_index.get, names, itertools.repeat(-1)),
+                           dtype=numpy.int64, count=len(names))
+    if numpy.any(found < 0):
+        raise RuntimeError('Unknown PostScript command: ' + names[numpy.flatnonzero(found < 0)[0]])
+    if len(positions) == 0 or positions[-1] != len(starts) - 1:
+        raise RuntimeError('PostScript ends without a command')
+    nargs = numpy.diff(positions, prepend=-1) - 1
+    return (numbers, found, nargs)
 
 def parse_postscript(commands):
-    point_sets = []
-    points = []
-    assert(commands[0].endswith('moveto'))
-    for cmd in commands:
-        if cmd.endswith('moveto'):
-            assert(len(points) == 0)
-            points.append(integerise(cmd))
-        elif cmd.endswith('rcurveto'):
-            points.append(integerise(cmd))
-        elif cmd.endswith('rlineto'):
-            points.append(integerise(cmd))
-        elif cmd.endswith('closepath'):
-            point_sets.append(points)
-            points = []
-        elif cmd == 'fill':
-            pass # There is more than one blob in the image. But that's ok.
-        else:
-            raise RuntimeError('Unknown PostScript command: ' + cmd)
-    assert(len(points) == 0)
-    return point_sets
-
-def potrace_image(filename):
-    p = subprocess.Popen(['potrace', '-c', '--eps', '-q', filename, '-o', '-'],
-                         stdout=subprocess.PIPE,
-                         universal_newlines=True)
-    (so, se) = p.communicate()
-    lines = so.split('\n')
-    while not lines[0].endswith('moveto'):
+    """Parse potrace's PostScript path commands.
+
+    Returns (kinds, coords) arrays with the relative coordinates
+    of the segments as they are in the file."""
+    import numpy
+    (numbers, found, nargs) = split_postscript(commands)
+    expected = numpy.array([c[2] for c in postscript_commands])
+    if numpy.any(expected[found] != nargs):
+        raise RuntimeError('Wrong number of PostScript arguments')
+    codes = numpy.array([-1 if c[1] is None else c[1] for c in postscript_commands],
+                        dtype=numpy.int8)
+    used = codes[found] >= 0
+    ops = codes[found][used]
+    nargs = nargs[used]
+    # Every path is a moveto, its segments and a closepath.
+    is_move = ops == segment_moveto
+    is_close = ops == segment_closepath
+    assert(is_move[0] and is_close[-1])
+    assert(numpy.array_equal(is_move[1:], is_close[:-1]))
+    kinds = ops[~is_close]
+    nargs = nargs[~is_close]
+    coords = numpy.zeros((len(kinds), 6), dtype=numpy.int64)
+    rows = numpy.repeat(numpy.arange(len(kinds)), nargs)
+    offsets = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(nargs) - nargs, nargs)
+    coords[rows, 6 - nargs[rows] + offsets] = numbers
+    return (kinds, coords)
+
+def potrace_eps(pbm):
+    """Trace an image given as the contents of a PBM file.
+
+    The image is piped to potrace and the EPS output is read
+    back, so no temporary files are needed. Returns the lines
+    with path commands."""
+    with profile.timer('trace.potrace'):
+        p = subprocess.Popen(['potrace'] + potrace_arguments + ['-', '-o', '-'],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+        (so, se) = p.communicate(pbm)
+    if p.returncode != 0:
+        raise RuntimeError('Potrace failed with exit code %d' % p.returncode)
+    lines = so.decode('ascii').split('\n')
+    while len(lines) > 0 and not lines[0].endswith('moveto'):
         lines.pop(0)
+    if len(lines) == 0:
+        # Nothing to trace in the image.
+        return lines
     while not lines[-1].endswith('closepath'):
         lines.pop()
-    pointset = parse_postscript(lines)
-    pointset = map(convert_points, pointset)
-    return pointset
-
-def crop_and_trace(image, box):
-    tfile = tempfile.NamedTemporaryFile(suffix='.pgm')
-    tempname = tfile.name
-    tfile.close()
-    cropped = image.copy(box)
-    if not cropped.save(tempname):
-        raise RuntimeError('Could not save cropped image')
-    points = potrace_image(tempname)
-    os.unlink(tempname)
+    return lines
+
+def eps_paths(lines):
+    """Parse potrace's path commands to (kinds, coords) arrays in
+    absolute coordinates."""
+    if len(lines) == 0:
+        return no_paths()
+    with profile.timer('trace.parse'):
+        (kinds, coords) = parse_postscript(lines)
+        return (kinds, to_absolute(kinds, coords))
+
+def potrace_paths(pbm):
+    return eps_paths(potrace_eps(pbm))
+
+def potrace_image(pbm):
+    return paths_to_curves(*potrace_paths(pbm))
+
+class PotraceProgram(object):
+    """Tracing backend that runs the potrace executable."""
+    name = 'program'
+
+    def available(self):
+        return i_haz_potrace()
+
+    def trace_paths(self, pbm):
+        return potrace_paths(pbm)
+
+    def trace(self, pbm):
+        return potrace_image(pbm)
+
+class PotraceLibrary(object):
+    """Tracing backend that calls libpotrace in process through the
+    pypotrace bindings, avoiding a new process for every glyph.
+
+    The curves are rounded the same way as potrace's EPS output so
+    that both backends give identical results."""
+    name = 'library'
+
+    def available(self):
+        try:
+            import potrace
+        except ImportError:
+            return False
+        # Other modules called potrace have a different interface.
+        return hasattr(potrace, 'potracelib_version')
+
+    def trace_paths(self, pbm):
+        import numpy
+        import potrace
+        from gtsegment import read_pbm_header
+        f = io.BytesIO(pbm)
+        (_, w, h) = read_pbm_header(f)
+        data = numpy.frombuffer(f.read(), dtype=numpy.uint8).reshape(h, (w + 7)//8)
+        pixels = numpy.unpackbits(data, axis=1, count=w)
+        # Potrace's y axis points up, the bottom row of the image is y = 0.
+        with profile.timer('trace.potrace'):
+            path = potrace.Bitmap(numpy.flipud(pixels)).trace()
+        return library_paths(path.curves)
+
+    def trace(self, pbm):
+        return paths_to_curves(*self.trace_paths(pbm))
+
+def library_paths(curves):
+    """Convert pypotrace curves to (kinds, coords) arrays, rounded
+    the same way as potrace's EPS output."""
+    import numpy
+    kinds = []
+    points = []
+    for curve in curves:
+        kinds.append(segment_moveto)
+        points += [0, 0, 0, 0] + list(curve.start_point)
+        for segment in curve.segments:
+            if segment.is_corner:
+                kinds += [segment_lineto, segment_lineto]
+                points += [0, 0, 0, 0] + list(segment.c)
+                points += [0, 0, 0, 0] + list(segment.end_point)
+            else:
+                kinds.append(segment_curveto)
+                points += list(segment.c1) + list(segment.c2) + list(segment.end_point)
+    kinds = numpy.array(kinds, dtype=numpy.int8)
+    coords = numpy.array(points, dtype=numpy.float64).reshape(-1, 6)
+    coords = numpy.floor(coords*potrace_pixel_multiplier + 0.5).astype(numpy.int64)
+    coords[kinds != segment_curveto, 0:4] = 0
+    return (kinds, coords)
+
+# In order of preference.
+tracers = [PotraceLibrary(), PotraceProgram()]
+
+@functools.lru_cache(maxsize=None)
+def find_tracer(name=None):
+    """Return the named tracing backend, or the first available one."""
+    for tracer in tracers:
+        if name is not None and tracer.name != name:
+            continue
+        if tracer.available():
+            return tracer
+    if name is None:
+        raise RuntimeError('Potrace is not available')
+    raise RuntimeError('Tracing backend %s is not available' % name)
+
+def crop_and_trace(image, box, cache=None, tracer=None):
+    if box.width() <= 0 or box.height() <= 0:
+        raise RuntimeError('Can not trace an empty box')
+    if tracer is None:
+        tracer = find_tracer()
+    with profile.timer('crop'):
+        pbm = image.crop_pbm(box.x(), box.y(), box.width(), box.height())
+    if cache is None:
+        with profile.timer('trace'):
+            return tracer.trace(pbm)
+    # Entries are kept apart per backend in case their results differ.
+    key = cache.key(pbm, [tracer.name] + potrace_arguments)
+    points = cache.get(key)
+    if points is None:
+        profile.count('cache_misses')
+        with profile.timer('trace'):
+            points = tracer.trace(pbm)
+        cache.put(key, points)
+    else:
+        profile.count('cache_hits')
     return points
 
-def convert_points(pointlist):
-    pointlist = to_absolute(pointlist)
-    return flip_curve(pointlist)
-
-def to_absolute(pointlist):
-    starting_point = pointlist[0]
-    assert(len(starting_point) == 2)
-    converted = [starting_point]
-    current_point = starting_point
-    for p in pointlist[1:]:
-        if len(p) == 2:
-            newp = [current_point[0] + p[0], current_point[1] + p[1]]
-        elif len(p) == 6:
-            newp = [0]*6
-            newp[0] = current_point[0] + p[0]
-            newp[1] = current_point[1] + p[1]
-            newp[2] = current_point[0] + p[2]
-            newp[3] = current_point[1] + p[3]
-            newp[4] = current_point[0] + p[4]
-            newp[5] = current_point[1] + p[5]
-        else:
-            raise RuntimeError('Unknown point size error.')
-        converted.append(newp)
-        current_point = [newp[-2], newp[-1]]
-    return converted
-
-def flip_curve(curve):
-    first = curve[0]
-    last = curve[-1]
-    assert(first[0] == last[-2])
-    assert(first[1] == last[-1])
-    flipped = [first]
-    for i in range(len(curve))[:0:-1]:
-        curp = curve[i]
-        if i == 0:
-            prevp = first
-        else:
-            prevp = curve[i-1]
-        if len(curp) == 6:
-            newp = curp[2:4] + curp[0:2] + prevp[-2:]
-        elif len(curp) == 2:
-            newp = prevp[-2:]
-        flipped.append(newp)
-    return flipped
-
-def pointlist_to_str(points, scale):
-    return ' '.join([str(scale*p) for p in points])
-
-def process_glyph(ofile, image, glyph, scale):
+def curve_counts(curves):
+    return {'contours': len(curves), 'segments': sum([len(c) - 1 for c in curves])}
+
+def trace_glyph(image, glyph, cache=None, tracer=None):
+    """crop_and_trace the box of glyph, recording the time and the
+    size of the result in the profile."""
+    if not profile.enabled:
+        return crop_and_trace(image, glyph.box.r, cache, tracer)
+    start = time.perf_counter()
+    curves = crop_and_trace(image, glyph.box.r, cache, tracer)
+    profile.glyph(glyph, trace_seconds=time.perf_counter() - start, **curve_counts(curves))
+    return curves
+
+def convert_points(kinds, coords):
+    """Turn parsed paths into the lists of points written to the SFD
+    file: absolute coordinates, reversed to the direction that
+    FontForge expects."""
+    return paths_to_curves(kinds, to_absolute(kinds, coords))
+
+def paths_to_curves(kinds, coords):
+    if len(kinds) == 0:
+        return []
+    with profile.timer('trace.convert'):
+        return contours_to_lists(*flip_curve(kinds, coords))
+
+def no_paths():
+    import numpy
+    return (numpy.zeros(0, dtype=numpy.int8), numpy.zeros((0, 6), dtype=numpy.int64))
+
+def path_starts(kinds):
+    import numpy
+    return numpy.flatnonzero(kinds == segment_moveto)
+
+def to_absolute(kinds, coords):
+    import numpy
+    # The end points are a running sum that restarts at every moveto.
+    starts = path_starts(kinds)
+    path = numpy.cumsum(kinds == segment_moveto) - 1
+    ends = numpy.cumsum(coords[:, 4:6], axis=0)
+    ends -= (ends[starts] - coords[starts, 4:6])[path]
+    previous = numpy.roll(ends, 1, axis=0)
+    previous[starts] = 0
+    absolute = coords + numpy.tile(previous, 3)
+    absolute[kinds != segment_curveto, 0:4] = 0
+    absolute[:, 4:6] = ends
+    return absolute
+
+def flip_curve(kinds, coords):
+    """Reverse the direction of every path."""
+    import numpy
+    starts = path_starts(kinds)
+    lengths = numpy.diff(starts, append=len(kinds))
+    lasts = starts + lengths - 1
+    assert(numpy.array_equal(coords[starts, 4:6], coords[lasts, 4:6]))
+    path = numpy.repeat(numpy.arange(len(starts)), lengths)
+    position = numpy.arange(len(kinds)) - starts[path]
+    # The moveto stays first, the other segments are taken from the
+    # end. A reversed segment ends where the original one began.
+    source = numpy.where(position == 0, starts[path], starts[path] + lengths[path] - position)
+    flipped = coords[source][:, [2, 3, 0, 1, 4, 5]]
+    segments = position > 0
+    flipped[segments, 4:6] = coords[source[segments] - 1, 4:6]
+    flipped[~segments] = coords[source[~segments]]
+    return (kinds[source], flipped)
+
+def contours_to_lists(kinds, coords):
+    is_curve = (kinds == segment_curveto).tolist()
+    points = [full if curve else end for (curve, full, end)
+              in zip(is_curve, coords.tolist(), coords[:, 4:6].tolist())]
+    bounds = path_starts(kinds).tolist() + [len(points)]
+    return [points[bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1)]
+
+def process_glyph(ofile, image, glyph, scale, tracer=None):
     if glyph.box is None:
         return
-    width = glyph.box.r.width()*potrace_pixel_multiplier*scale + rbearing
-    location3 = 0
-    ofile.write(letter_header % (glyph.name, glyph.codepoint, glyph.codepoint, location3, width))
-    points = crop_and_trace(image, glyph.box.r)
-    for curve in points:
-        fp = curve[0]
-        assert(len(fp) == 2)
-        ofile.write(pointlist_to_str(fp, scale))
-        ofile.write(" m 0\n")
+    write_glyph(ofile, glyph, crop_and_trace(image, glyph.box.r, tracer=tracer), scale)
+
+def glyph_width(glyph, scale):
+    return glyph.box.r.width()*potrace_pixel_multiplier*scale + rbearing
+
+def scale_coordinates(points, scale, precision=None):
+    """Scale all coordinates of the curves at once. With no precision
+    the numbers are written in full as in earlier versions, otherwise
+    they are rounded to that many decimals. If scale is None the
+    points are already in font units."""
+    import numpy
+    values = [v for curve in points for point in curve for v in point]
+    if scale is None:
+        return values
+    scaled = numpy.array(values, dtype=numpy.float64)*scale
+    if precision is not None:
+        scaled = numpy.round(scaled, precision)
+    return scaled.tolist()
+
+# Templates of the SFD spline commands, by the number of coordinates
+# and whether the next segment is a line.
+spline_templates = {(2, False): ' %s %s l 2\n',
+                    (2, True): ' %s %s l 1\n',
+                    (6, False): ' %s %s %s %s %s %s c 0\n',
+                    (6, True): ' %s %s %s %s %s %s c 2\n'}
 
+def splines_text(points, scale, precision=None):
+    """The SFD spline set of the curves, formatted with one template
+    for the whole glyph."""
+    templates = []
+    for curve in points:
+        assert(len(curve[0]) == 2)
+        templates.append('%s %s m 0\n')
         for i in range(1, len(curve)):
-            point = curve[i]
-            ofile.write(' ')
-            ofile.write(pointlist_to_str(point, scale))
-            # Print move commands.
-            if len(point) == 6:
-                if i < len(curve)-1 and len(curve[i+1]) == 2:
-                    flags = 2
-                else:
-                    flags = 0
-                ofile.write(' c %d\n' % flags)
-            elif len(point) == 2:
-                if i < len(curve)-1 and len(curve[i+1]) == 2:
-                    flags = 1
-                else:
-                    flags = 2
-                ofile.write(' l %d\n' % flags)
-            else:
-                raise RuntimeError('Incorrect amount of points: %d' % len(point))
-    ofile.write(letter_footer)
+            line_follows = i < len(curve)-1 and len(curve[i+1]) == 2
+            template = spline_templates.get((len(curve[i]), line_follows))
+            if template is None:
+                raise RuntimeError('Incorrect amount of points: %d' % len(curve[i]))
+            templates.append(template)
+    return ''.join(templates) % tuple(scale_coordinates(points, scale, precision))
+
+def glyph_text(glyph, points, scale, precision=None):
+    location3 = 0
+    return letter_header % (glyph.name, glyph.codepoint, glyph.codepoint, location3,
+                            glyph_width(glyph, scale)) + \
+        splines_text(points, scale, precision) + letter_footer
+
+def write_glyph(ofile, glyph, points, scale, precision=None):
+    ofile.write(glyph_text(glyph, points, scale, precision))
+
+def write_profiled_glyph(ofile, glyph, points, scale, precision=None):
+    """write_glyph that records the time and bytes taken by the glyph
+    when profiling."""
+    if not profile.enabled:
+        ofile.write(glyph_text(glyph, points, scale, precision))
+        return
+    with profile.timer('write.glyph') as t:
+        text = glyph_text(glyph, points, scale, precision)
+        ofile.write(text)
+    size = len(text.encode('utf-8'))
+    profile.glyph(glyph, write_seconds=t.seconds, bytes=size)
+    profile.count('bytes_written', size)
+
+# Glyphs are collected into pieces of about this size before writing.
+write_block_bytes = 1024*1024
+
+class BlockWriter(object):
+    """File like object that writes the text given to it to ofile in
+    large pieces."""
+    def __init__(self, ofile, block_bytes=write_block_bytes):
+        self.ofile = ofile
+        self.block_bytes = block_bytes
+        self.blocks = []
+        self.pending = 0
+
+    def write(self, text):
+        self.blocks.append(text)
+        self.pending += len(text)
+        if self.pending >= self.block_bytes:
+            self.flush()
+
+    def flush(self):
+        if len(self.blocks) > 0:
+            self.ofile.write(''.join(self.blocks))
+            self.blocks = []
+            self.pending = 0
+
+    def sync(self):
+        """Write everything to the disk."""
+        self.flush()
+        self.ofile.flush()
+        os.fsync(self.ofile.fileno())
+
+# Optional reduction of the SFD output.
+
+def quantize(value, grid):
+    q = round(round(value/grid)*grid, 6)
+    if q == int(q):
+        return int(q)
+    return q
+
+def cross(a, b, c):
+    return (b[0] - a[0])*(c[1] - a[1]) - (b[1] - a[1])*(c[0] - a[0])
+
+def dot(a, b, c):
+    return (b[0] - a[0])*(c[0] - a[0]) + (b[1] - a[1])*(c[1] - a[1])
+
+def is_straight_curve(start, point):
+    """True if the control points of a curve lie on its chord."""
+    end = point[4:6]
+    chord = dot(start, end, end)
+    for c in (point[0:2], point[2:4]):
+        if cross(start, end, c) != 0 or not 0 <= dot(start, end, c) <= chord:
+            return False
+    return True
+
+def simplify_curve(curve, scale, grid):
+    """Scale a traced curve to font units rounded to multiples of
+    grid. Curves with straight control points become lines, segments
+    of no length are dropped and lines that continue in the same
+    direction are merged. Returns None if nothing with an area is
+    left."""
+    points = [[quantize(scale*v, grid) for v in p] for p in curve]
+    result = [points[0]]
+    last = points[0]
+    for p in points[1:]:
+        end = p[-2:]
+        if len(p) == 6 and is_straight_curve(last, p):
+            p = end
+        if len(p) == 6:
+            if p[0:2] == last and p[2:4] == last and end == last:
+                continue
+        elif end == last:
+            continue
+        elif len(result) > 1 and len(result[-1]) == 2:
+            before = result[-2][-2:]
+            if cross(before, last, end) == 0 and dot(before, last, end) > 0:
+                result[-1] = end
+                last = end
+                continue
+        result.append(p)
+        last = end
+    segments = result[1:]
+    if len(segments) == 0:
+        return None
+    if len(segments) < 3 and all([len(p) == 2 for p in segments]):
+        return None
+    return result
+
+def count_points(points):
+    return sum([sum([len(p)//2 for p in curve]) for curve in points])
+
+class SfdOptimizer(object):
+    """Writes smaller SFD files. Coordinates are rounded to multiples
+    of grid font units and the curves are simplified, see
+    simplify_curve. If dedupe is set, glyphs with the same width and
+    curves as an earlier glyph are written as references to it.
+
+    The sizes before and after are collected for summary()."""
+    def __init__(self, grid=1, dedupe=True):
+        if grid <= 0:
+            raise RuntimeError('Grid must be positive')
+        self.grid = grid
+        self.dedupe = dedupe
+        self.shapes = {}
+        self.glyphs = 0
+        self.references = 0
+        self.points_before = 0
+        self.points_after = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def write_glyph(self, ofile, glyph, points, scale, position):
+        """Write glyph, position is its index in the font."""
+        self.bytes_before += len(glyph_text(glyph, points, scale))
+        self.points_before += count_points(points)
+
+        curves = [simplify_curve(c, scale, self.grid) for c in points]
+        curves = [c for c in curves if c is not None]
+        width = quantize(glyph_width(glyph, scale), self.grid)
+        header = letter_header % (glyph.name, glyph.codepoint, glyph.codepoint, position, width)
+        splines = splines_text(curves, None)
+        digest = hashlib.sha1(('%d\n%s' % (width, splines)).encode('ascii')).hexdigest()
+        original = self.shapes.get(digest)
+        if self.dedupe and original is not None and len(curves) > 0:
+            text = header + reference_footer % original
+            self.references += 1
+        else:
+            text = header + splines + letter_footer
+            self.shapes.setdefault(digest, (position, glyph.codepoint))
+            self.points_after += count_points(curves)
+        ofile.write(text)
+        self.bytes_after += len(text)
+        self.glyphs += 1
+
+    def summary(self):
+        def reduction(before, after):
+            if before == 0:
+                return 0.0
+            return 100.0*(before - after)/before
+        return '%d glyphs, %d written as references, %d -> %d points (%.1f%% fewer), ' \
+               '%d -> %d bytes (%.1f%% smaller)' % \
+               (self.glyphs, self.references, self.points_before, self.points_after,
+                reduction(self.points_before, self.points_after),
+                self.bytes_before, self.bytes_after,
+                reduction(self.bytes_before, self.bytes_after))
 
 def max_y(glyphs):
     """Return the the height of the tallest letter box."""
@@ -374,17 +968,289 @@ def calculate_scale(glyphs):
     highest_box = max_y(glyphs)
     return highest_y_coordinate/(potrace_pixel_multiplier*highest_box)
 
-def write_sfd(ofilename, fontname, image, glyphs):
-    ofile = open(ofilename, 'w')
+def default_jobs():
+    return os.cpu_count() or 1
+
+def trace_glyphs(image, glyphs, jobs=None, cache=None, tracer=None):
+    """Trace the boxes of glyphs with jobs parallel workers.
+
+    Yields (glyph, curves) pairs in the order of glyphs. If any
+    trace fails, the jobs that have not started yet are cancelled
+    and the error is raised. Traces found in the optional
+    TraceCache are not run again. If no tracer is given the best
+    available backend is used."""
+    glyphs = [g for g in glyphs if g.box is not None]
+    if jobs is None:
+        jobs = default_jobs()
+    if tracer is None and len(glyphs) > 0:
+        tracer = find_tracer()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(trace_glyph, image, g, cache, tracer) for g in glyphs]
+        try:
+            for (glyph, future) in zip(glyphs, futures):
+                yield (glyph, future.result())
+        finally:
+            for future in futures:
+                future.cancel()
+
+# Tracing many glyphs with one potrace run. The area around a group
+# of boxes is traced with the pixels outside the boxes cleared, and
+# the paths are then handed out to the boxes that contain them.
+
+def masked_pbm(image, rects):
+    """Return PBM data of the area covering rects, with the pixels
+    outside the rectangles cleared, and the corner of the area."""
+    import numpy
+    from gtsegment import pixels_to_pbm
+    x0 = min(r.x() for r in rects)
+    y0 = min(r.y() for r in rects)
+    x1 = max(r.x() + r.width() for r in rects)
+    y1 = max(r.y() + r.height() for r in rects)
+    pixels = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.uint8)
+    for r in rects:
+        pixels[r.y()-y0:r.y()-y0+r.height(), r.x()-x0:r.x()-x0+r.width()] = \
+            image.pixels(r.x(), r.y(), r.width(), r.height())
+    return (pixels_to_pbm(pixels), x0, y0)
+
+def split_paths(kinds, coords, rects, height, tolerance=potrace_pixel_multiplier):
+    """Distribute the paths traced from an image of the given height
+    to the rects that contain their end points, allowing tolerance
+    units outside of the rectangle. Paths that do not fit in any
+    rectangle are dropped.
+
+    Returns a (kinds, coords) pair for every rect, translated so
+    that the bottom left corner of the rect is the origin."""
+    import numpy
+    m = potrace_pixel_multiplier
+    starts = path_starts(kinds)
+    owners = numpy.full(len(starts), -1)
+    if len(starts) > 0:
+        lows = numpy.minimum.reduceat(coords[:, 4:6], starts, axis=0)
+        highs = numpy.maximum.reduceat(coords[:, 4:6], starts, axis=0)
+        boxes = [LetterBox(r) for r in rects]
+        numbers = dict([(id(b), i) for (i, b) in enumerate(boxes)])
+        index = BoxIndex(boxes)
+        centers = (lows + highs)/(2.0*m)
+        for (i, (cx, cy)) in enumerate(centers.tolist()):
+            # Potrace's y axis points up.
+            b = index.find(int(cx), height - 1 - int(cy))
+            if b is None:
+                continue
+            r = b.r
+            if lows[i, 0] >= r.x()*m - tolerance and \
+               highs[i, 0] <= (r.x() + r.width())*m + tolerance and \
+               lows[i, 1] >= (height - r.y() - r.height())*m - tolerance and \
+               highs[i, 1] <= (height - r.y())*m + tolerance:
+                owners[i] = numbers[id(b)]
+    owners = owners[numpy.cumsum(kinds == segment_moveto) - 1]
+    order = numpy.argsort(owners, kind='stable')
+    bounds = numpy.searchsorted(owners[order], numpy.arange(len(rects) + 1))
+    result = []
+    for (i, r) in enumerate(rects):
+        rows = order[bounds[i]:bounds[i+1]]
+        offset = numpy.array([r.x()*m, (height - r.y() - r.height())*m]*3)
+        local = coords[rows] - offset
+        local[kinds[rows] != segment_curveto, 0:4] = 0
+        result.append((kinds[rows], local))
+    return result
+
+def trace_area(image, rects, tracer):
+    with profile.timer('crop'):
+        (pbm, x0, y0) = masked_pbm(image, rects)
+    with profile.timer('trace'):
+        (kinds, coords) = tracer.trace_paths(pbm)
+    height = max(r.y() + r.height() for r in rects) - y0
+    local = [Rect(r.x() - x0, r.y() - y0, r.width(), r.height()) for r in rects]
+    parts = split_paths(kinds, coords, local, height)
+    return dict([(r, paths_to_curves(*p)) for (r, p) in zip(rects, parts)])
+
+def trace_page(image, glyphs, jobs=None, tracer=None):
+    """Like trace_glyphs, but runs potrace once per group of rows of
+    boxes instead of once per glyph. There are as many groups as
+    jobs.
+
+    The curves are not always the same as with trace_glyphs.
+    Potrace computes with coordinates in the whole image, and where
+    its curve fitting has near ties the rounding of its floating
+    point arithmetic decides them differently at another position.
+    On generated sheets about one glyph in ten came out differently:
+    curve segments are split or joined in other places, so a contour
+    may have a different number of segments, and the outline may
+    move by up to about a quarter of a pixel. The contours themselves
+    are the same. Glyphs only a few pixels apart may differ more, as
+    potrace looks at the neighbouring pixels when resolving ambiguous
+    corners."""
+    glyphs = [g for g in glyphs if g.box is not None]
+    if len(glyphs) == 0:
+        return
+    if jobs is None:
+        jobs = default_jobs()
+    if tracer is None:
+        tracer = find_tracer()
+    rects = sorted(set([g.box.r for g in glyphs]), key=lambda r: (r.y(), r.x()))
+    groups = max(1, min(jobs, len(rects)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=groups) as executor:
+        futures = {}
+        for i in range(groups):
+            group = rects[i*len(rects)//groups:(i+1)*len(rects)//groups]
+            future = executor.submit(trace_area, image, group, tracer)
+            for r in group:
+                futures[r] = future
+        try:
+            for glyph in glyphs:
+                curves = futures[glyph.box.r].result()[glyph.box.r]
+                profile.glyph(glyph, **curve_counts(curves))
+                yield (glyph, curves)
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+def traced_glyphs(image, glyphs, jobs, cache, tracer, whole_page):
+    if whole_page:
+        # The cache is not used, a trace depends on the neighbouring glyphs.
+        return trace_page(image, glyphs, jobs, tracer)
+    return trace_glyphs(image, glyphs, jobs, cache, tracer)
+
+def write_sfd(ofilename, fontname, image, glyphs, jobs=None, cache=None, tracer=None,
+              whole_page=False, optimizer=None, precision=None):
+    """Trace glyphs and write them to an SFD file. Coordinates are
+    rounded to precision decimals if it is given, by default the
+    output is the same as with earlier versions."""
     font_name = fontname
     full_name = fontname
     family_name = fontname
     num_letters = len(glyphs)
     scale = calculate_scale(glyphs)
 
-    ofile.write(sfd_header % (font_name, full_name, family_name, ascent, descent, num_letters))
+    # A state file left by update_sfd no longer describes the file.
+    try:
+        os.unlink(sfd_state_file(ofilename))
+    except FileNotFoundError:
+        pass
+    with open(ofilename, 'w') as f:
+        ofile = BlockWriter(f)
+        ofile.write(sfd_header % (font_name, full_name, family_name, ascent, descent, num_letters))
+
+        traced = traced_glyphs(image, glyphs, jobs, cache, tracer, whole_page)
+        for (position, (glyph, points)) in enumerate(traced):
+            if optimizer is None:
+                write_profiled_glyph(ofile, glyph, points, scale, precision)
+            else:
+                optimizer.write_glyph(ofile, glyph, points, scale, position)
+
+        ofile.write(sfd_footer)
+        ofile.sync()
 
-    for glyph in glyphs:
-        process_glyph(ofile, image, glyph, scale)
+def sfd_state_file(ofilename):
+    return ofilename + '.gtstate'
+
+def glyph_digest(image, glyph):
+    """Hash of everything that affects the traced form of a glyph."""
+    r = glyph.box.r
+    h = hashlib.sha256()
+    h.update(('%s %d %d %d %d %d\n' % (glyph.name, glyph.codepoint,
+                                        r.x(), r.y(), r.width(), r.height())).encode('utf-8'))
+    h.update(image.crop_pbm(r.x(), r.y(), r.width(), r.height()))
+    return h.hexdigest()
+
+def text_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def split_sfd(text):
+    """Split an SFD file written by Glyphtracer into its header, a dict
+    of StartChar...EndChar blocks keyed by code point and the footer."""
+    end = text.rfind('EndChars')
+    if end < 0:
+        raise RuntimeError('Not a Glyphtracer SFD file')
+    start = text.find('StartChar:')
+    if start < 0 or start > end:
+        start = end
+    blocks = {}
+    for block in re.findall(r'^StartChar:.*?^EndChar\n\n', text[start:end], re.M | re.S):
+        m = re.search(r'^Encoding: (\d+)', block, re.M)
+        if m is None:
+            raise RuntimeError('Glyph without encoding in SFD file')
+        blocks[int(m.group(1))] = block
+    return (text[:start], blocks, text[end:])
+
+def replacement_mode(fname, default=0o666):
+    """Permissions for a file or directory that replaces fname: those of
+    the existing one, or default limited by the umask like a newly
+    created file."""
+    try:
+        return stat.S_IMODE(os.stat(fname).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return default & ~umask
+
+def write_file_atomically(ofilename, text):
+    (fd, tempname) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ofilename)),
+                                      prefix=os.path.basename(ofilename), suffix='.tmp')
+    try:
+        # mkstemp makes the file readable by the owner only.
+        os.fchmod(fd, replacement_mode(ofilename))
+        with os.fdopen(fd, 'w') as ofile:
+            ofile.write(text)
+            ofile.flush()
+            os.fsync(ofile.fileno())
+        os.replace(tempname, ofilename)
+    except:
+        os.unlink(tempname)
+        raise
+
+def update_sfd(ofilename, fontname, image, glyphs, jobs=None, cache=None, tracer=None,
+               whole_page=False, precision=None):
+    """Write an SFD file, retracing only the glyphs that have changed.
+
+    The hashes of the glyphs are kept in a state file next to the
+    SFD file. Glyphs whose box or pixels are unchanged since the
+    previous run keep their old block from the existing file. If the
+    SFD file has been changed since, or the tracing settings differ,
+    every glyph is traced again. Returns the number of glyphs that
+    were traced."""
+    if tracer is None:
+        tracer = find_tracer()
+    glyphs = [g for g in glyphs if g.box is not None]
+    scale = calculate_scale(glyphs)
+    digests = [glyph_digest(image, g) for g in glyphs]
+    state_file = sfd_state_file(ofilename)
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        with open(ofilename, 'r') as f:
+            text = f.read()
+        (header, blocks, footer) = split_sfd(text)
+        if state['font'] != fontname or state['scale'] != scale or \
+           state.get('precision') != precision or state.get('tracer') != tracer.name or \
+           state.get('whole_page') != whole_page or state.get('sfd') != text_digest(text):
+            state = None
+    except (OSError, ValueError, KeyError, RuntimeError):
+        state = None
+    if state is None:
+        old_digests = {}
+        blocks = {}
+        header = sfd_header % (fontname, fontname, fontname, ascent, descent, len(glyphs))
+        footer = sfd_footer
+    else:
+        old_digests = state['glyphs']
+        header = re.sub(r'^BeginChars: (\d+) \d+$', r'BeginChars: \g<1> %d' % len(glyphs),
+                        header, flags=re.M)
+    changed = [g for (g, d) in zip(glyphs, digests)
+               if old_digests.get(str(g.codepoint)) != d or g.codepoint not in blocks]
+    for (glyph, points) in traced_glyphs(image, changed, jobs, cache, tracer, whole_page):
+        buf = io.StringIO()
+        write_profiled_glyph(buf, glyph, points, scale, precision)
+        blocks[glyph.codepoint] = buf.getvalue()
 
-    ofile.write(sfd_footer)
+    text = header + ''.join([blocks[g.codepoint] for g in glyphs]) + footer
+    write_file_atomically(ofilename, text)
+    state = {'font': fontname,
+             'scale': scale,
+             'precision': precision,
+             'tracer': tracer.name,
+             'whole_page': whole_page,
+             'sfd': text_digest(text),
+             'glyphs': dict([(str(g.codepoint), d) for (g, d) in zip(glyphs, digests)])}
+    write_file_atomically(state_file, json.dumps(state))
+    return len(changed)
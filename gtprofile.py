@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Timers and counters of the processing stages.
+#
+# Profiling is off unless enabled with the --profile option of the
+# batch mode or by setting GLYPHTRACER_PROFILE to the name of the
+# report file. While it is off the instrumentation only costs a
+# method call.
+
+import os, json, time, threading
+
+profile_format = 'glyphtracer-profile'
+profile_version = 1
+profile_variable = 'GLYPHTRACER_PROFILE'
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+null_timer = NullTimer()
+
+class Timer(object):
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.perf_counter() - self.start
+        self.profile.add_time(self.name, self.seconds)
+        return False
+
+class Profile(object):
+    """Collects the time spent in named stages, counters and values
+    recorded for single glyphs. Safe to use from several threads."""
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.timers = {}
+            self.counters = {}
+            self.glyphs = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def timer(self, name):
+        """Context manager that adds its running time to the named timer."""
+        if not self.enabled:
+            return null_timer
+        return Timer(self, name)
+
+    def add_time(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            t = self.timers.get(name)
+            if t is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                t[0] += 1
+                t[1] += seconds
+                t[2] = max(t[2], seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def glyph(self, glyph, **values):
+        """Record values such as trace time or contour count for a glyph."""
+        if not self.enabled:
+            return
+        with self.lock:
+            record = self.glyphs.get(glyph.codepoint)
+            if record is None:
+                record = {'name': glyph.name, 'codepoint': glyph.codepoint}
+                self.glyphs[glyph.codepoint] = record
+            record.update(values)
+
+    def report(self):
+        with self.lock:
+            timers = dict([(name, {'count': t[0], 'total': t[1], 'max': t[2]})
+                           for (name, t) in self.timers.items()])
+            return {'format': profile_format,
+                    'version': profile_version,
+                    'seconds': time.perf_counter() - self.started,
+                    'timers': timers,
+                    'counters': dict(self.counters),
+                    'glyphs': [self.glyphs[cp] for cp in sorted(self.glyphs)]}
+
+def write_report(fname, report):
+    with open(fname, 'w') as f:
+        json.dump(report, f, indent=1)
+
+def profile_file_from_environment():
+    """The report file named in the environment, or None."""
+    fname = os.environ.get(profile_variable, '')
+    if fname == '':
+        return None
+    return fname
+
+profile = Profile()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Project files that remember the boxes and glyph assignments of a sheet.
+#
+# A project file is a journal of JSON lines. The first line identifies
+# the image by the hash of its pixels, the second has the letter boxes
+# and every following line records one assignment change. Saving only
+# appends the changes, the file is rewritten when it has grown much
+# larger than the current state.
+
+import os, json
+from gtlib import write_file_atomically
+from gtsegment import no_filter
+
+project_format = 'glyphtracer-project'
+project_version = 1
+
+class ProjectFile(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.ofile = None
+        self.box_numbers = {}
+        self.records = None
+
+    def load(self, image_hash, segmentation, noise=no_filter):
+        """Read the project. Returns (rects, assignments) where
+        assignments is a list of (name, codepoint, box number), or
+        None if the file does not exist, is for another image or other
+        segmentation settings, or refers to boxes that it does not
+        have."""
+        try:
+            with open(self.fname, 'r') as f:
+                lines = f.readlines()
+            header = json.loads(lines[0])
+            if header.get('format') != project_format or \
+               header.get('version') != project_version or \
+               header.get('image_hash') != image_hash or \
+               header.get('segmentation') != segmentation or \
+               header.get('noise', no_filter.to_json()) != noise.to_json():
+                return None
+            rects = [tuple(r) for r in json.loads(lines[1])['boxes']]
+            assigned = {}
+            records = len(lines) - 2
+            for line in lines[2:]:
+                if not line.endswith('\n'):
+                    # A partially written last record, start() will
+                    # write a new snapshot without it.
+                    records = None
+                    break
+                record = json.loads(line)
+                if 'assign' in record:
+                    box = record['box']
+                    if not isinstance(box, int) or not 0 <= box < len(rects):
+                        raise ValueError('Box number out of range: %r' % (box,))
+                    assigned[record['assign']] = (record['name'], record['assign'], box)
+                else:
+                    assigned.pop(record['unassign'], None)
+        except (OSError, ValueError, IndexError, KeyError):
+            return None
+        self.records = records
+        return (rects, list(assigned.values()))
+
+    def start(self, image_hash, segmentation, boxes, glyphs, noise=no_filter):
+        """Begin recording changes to boxes, glyphs are the current
+        assignments. A fresh snapshot is written if the journal is
+        missing or has grown too long."""
+        self.box_numbers = dict([(id(b), i) for (i, b) in enumerate(boxes)])
+        if self.records is None or self.records > 2*len(glyphs) + 64:
+            header = {'format': project_format,
+                      'version': project_version,
+                      'image_hash': image_hash,
+                      'segmentation': segmentation,
+                      'noise': noise.to_json()}
+            rects = [[b.r.x(), b.r.y(), b.r.width(), b.r.height()] for b in boxes]
+            lines = [json.dumps(header), json.dumps({'boxes': rects}, separators=(',', ':'))]
+            lines += [self.assign_record(g, g.box) for g in glyphs]
+            write_file_atomically(self.fname, '\n'.join(lines) + '\n')
+            self.records = len(glyphs)
+        self.ofile = open(self.fname, 'a')
+
+    def assign_record(self, glyph, box):
+        return json.dumps({'assign': glyph.codepoint,
+                           'name': glyph.name,
+                           'box': self.box_numbers[id(box)]})
+
+    def record(self, glyph, old_box, new_box):
+        """Assignment listener that appends the change to the journal."""
+        if self.ofile is None:
+            return
+        if new_box is None:
+            line = json.dumps({'unassign': glyph.codepoint})
+        else:
+            line = self.assign_record(glyph, new_box)
+        self.ofile.write(line + '\n')
+        self.ofile.flush()
+        self.records += 1
+
+    def close(self):
+        if self.ofile is not None:
+            self.ofile.flush()
+            os.fsync(self.ofile.fileno())
+            self.ofile.close()
+            self.ofile = None
@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Bitmap access and projection profiles for 1 bit images.
+
+import os, hashlib
+import numpy
+from gtprofile import profile
+
+# Number of set bits in every possible byte value.
+popcount_table = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+# Upper limit for the size of the unpacked pixel temporaries. Images
+# are processed in bands of rows that fit in it, so memory use does
+# not grow with the page size.
+default_band_bytes = 16*1024*1024
+
+class NoiseFilter(object):
+    """Settings that keep specks of dust from becoming letter boxes in
+    white space segmentation. The defaults do no filtering.
+
+    A row or column needs min_ink black pixels to be part of a
+    letter. Gaps narrower than min_gap pixels do not separate letters
+    and strips of rows or columns that are still narrower than
+    min_strip pixels after joining them are ignored. If despeckle is above zero, black pixels with fewer black
+    neighbours than that are not counted."""
+    def __init__(self, min_ink=1, min_strip=1, min_gap=1, despeckle=0):
+        self.min_ink = min_ink
+        self.min_strip = min_strip
+        self.min_gap = min_gap
+        self.despeckle = despeckle
+
+    def to_json(self):
+        return {'min_ink': self.min_ink,
+                'min_strip': self.min_strip,
+                'min_gap': self.min_gap,
+                'despeckle': self.despeckle}
+
+no_filter = NoiseFilter()
+
+class Bitmap(object):
+    """A read only view to packed 1 bit pixel rows.
+
+    The pixel data is not copied, it is accessed through a NumPy
+    array of shape (height, bytes_per_line). This can also be a
+    memory map of a file, only the rows being worked on are read."""
+    def __init__(self, data, width, height, black_index, lsb_first=False, owner=None,
+                 band_bytes=default_band_bytes):
+        self.data = data
+        self.w = width
+        self.h = height
+        self.black_index = black_index
+        self.bitorder = 'little' if lsb_first else 'big'
+        # Keeps the object that owns the pixel buffer alive.
+        self.owner = owner
+        self.row_mask = self.build_row_mask()
+        self.band_rows = max(1, band_bytes//max(1, self.data.shape[1]*8))
+
+    @staticmethod
+    def from_buffer(buf, width, height, bytes_per_line, black_index, lsb_first=False, owner=None):
+        data = numpy.frombuffer(buf, dtype=numpy.uint8, count=bytes_per_line*height)
+        data = data.reshape(height, bytes_per_line)
+        return Bitmap(data, width, height, black_index, lsb_first, owner)
+
+    def bands(self, y0=0, y1=None):
+        """Split rows [y0, y1) into (start, end) bands."""
+        if y1 is None:
+            y1 = self.h
+        return [(start, min(start + self.band_rows, y1))
+                for start in range(y0, y1, self.band_rows)]
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+    def build_row_mask(self):
+        # Selects the bits that belong to actual pixels, padding
+        # at the end of every row is zeroed.
+        bits = numpy.zeros(self.data.shape[1]*8, dtype=numpy.uint8)
+        bits[:self.w] = 1
+        return numpy.packbits(bits, bitorder=self.bitorder)
+
+    def pixels(self, x, y, w, h):
+        """Unpacked pixels of the given area, 1 is black."""
+        bits = numpy.unpackbits(self.data[y:y+h], axis=1, count=x+w,
+                                bitorder=self.bitorder)[:, x:]
+        if self.black_index == 0:
+            bits ^= 1
+        return bits
+
+    def crop_pbm(self, x, y, w, h):
+        """Return the given area as the contents of a binary PBM file."""
+        return pixels_to_pbm(self.pixels(x, y, w, h))
+
+    def digest(self):
+        """Hash of the pixels, independent of the storage format."""
+        h = hashlib.sha256(b'%d %d\n' % (self.w, self.h))
+        for (start, end) in self.bands():
+            bits = numpy.unpackbits(self.data[start:end], axis=1,
+                                    count=self.w, bitorder=self.bitorder)
+            if self.black_index == 0:
+                bits ^= 1
+            h.update(numpy.packbits(bits, axis=1).tobytes())
+        return h.hexdigest()
+
+    def despeckled(self, start, end, min_neighbours):
+        """Unpacked pixels of rows [start, end), 1 is black, with the
+        black pixels that have fewer than min_neighbours black pixels
+        around them cleared."""
+        y0 = max(start - 1, 0)
+        y1 = min(end + 1, self.h)
+        bits = numpy.unpackbits(self.data[y0:y1], axis=1, count=self.w,
+                                bitorder=self.bitorder)
+        if self.black_index == 0:
+            bits ^= 1
+        padded = numpy.pad(bits, 1)
+        (h, w) = bits.shape
+        neighbours = numpy.zeros((h, w), dtype=numpy.uint8)
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                if dy != 1 or dx != 1:
+                    neighbours += padded[dy:dy+h, dx:dx+w]
+        bits &= neighbours >= min_neighbours
+        return bits[start-y0:end-y0]
+
+    def row_sums(self, y0=0, y1=None, progress=None, despeckle=0):
+        """Number of black pixels on each row in [y0, y1), not counting
+        specks if despeckle is set, see NoiseFilter."""
+        if y1 is None:
+            y1 = self.h
+        sums = numpy.empty(max(y1-y0, 0), dtype=numpy.int64)
+        for (start, end) in self.bands(y0, y1):
+            if despeckle > 0:
+                sums[start-y0:end-y0] = self.despeckled(start, end, despeckle).sum(axis=1)
+                if progress is not None:
+                    progress(end)
+                continue
+            masked = self.data[start:end] & self.row_mask
+            ones = popcount_table[masked].sum(axis=1, dtype=numpy.int64)
+            if self.black_index == 1:
+                sums[start-y0:end-y0] = ones
+            else:
+                sums[start-y0:end-y0] = self.w - ones
+            if progress is not None:
+                progress(end)
+        return sums.tolist()
+
+    def column_sums(self, y0=0, y1=None, despeckle=0):
+        """Number of black pixels on each column within rows [y0, y1)."""
+        if y1 is None:
+            y1 = self.h
+        if despeckle > 0:
+            sums = numpy.zeros(self.w, dtype=numpy.int64)
+            for (start, end) in self.bands(y0, y1):
+                sums += self.despeckled(start, end, despeckle).sum(axis=0, dtype=numpy.int64)
+            return sums.tolist()
+        ones = numpy.zeros(self.w, dtype=numpy.int64)
+        for (start, end) in self.bands(y0, y1):
+            bits = numpy.unpackbits(self.data[start:end], axis=1, count=self.w,
+                                    bitorder=self.bitorder)
+            ones += bits.sum(axis=0, dtype=numpy.int64)
+        if self.black_index == 1:
+            return ones.tolist()
+        return (max(y1-y0, 0) - ones).tolist()
+
+def pixels_to_pbm(pixels):
+    (h, w) = pixels.shape
+    return b'P4\n%d %d\n' % (w, h) + numpy.packbits(pixels, axis=1).tobytes()
+
+def read_pbm_header(f):
+    """Parse a PBM header, returning (magic, width, height)."""
+    tokens = []
+    while len(tokens) < 3:
+        line = f.readline()
+        if line == b'':
+            raise RuntimeError('Truncated PBM header')
+        tokens += line.split(b'#')[0].split()
+    if tokens[0] not in (b'P1', b'P4') or len(tokens) != 3:
+        raise RuntimeError('Not a PBM file')
+    return (tokens[0], int(tokens[1]), int(tokens[2]))
+
+def read_pbm(fname, band_bytes=default_band_bytes):
+    """Load a PBM file. Binary files are memory mapped rather than
+    read, so even scans larger than the memory can be segmented."""
+    with open(fname, 'rb') as f:
+        (magic, w, h) = read_pbm_header(f)
+        if magic == b'P4':
+            stride = (w + 7)//8
+            offset = f.tell()
+            if os.fstat(f.fileno()).st_size - offset < stride*h:
+                raise RuntimeError('Truncated PBM file')
+            if stride*h == 0:
+                data = numpy.zeros((h, stride), dtype=numpy.uint8)
+            else:
+                data = numpy.memmap(f, dtype=numpy.uint8, mode='r', offset=offset,
+                                    shape=(h, stride))
+            return Bitmap(data, w, h, 1, band_bytes=band_bytes)
+        digits = numpy.frombuffer(f.read(), dtype=numpy.uint8)
+    # Plain PBM, pixels are the characters 0 and 1 separated by optional whitespace.
+    pixels = digits[(digits == ord('0')) | (digits == ord('1'))] - ord('0')
+    if len(pixels) < w*h:
+        raise RuntimeError('Truncated PBM file')
+    return Bitmap(numpy.packbits(pixels[:w*h].reshape(h, w), axis=1), w, h, 1,
+                  band_bytes=band_bytes)
+
+def load_bitmap(fname, band_bytes=default_band_bytes):
+    """Load a 1 bit image. PBM files are read directly, other formats
+    need Qt's image loaders."""
+    with open(fname, 'rb') as f:
+        magic = f.read(2)
+    with profile.timer('load'):
+        if magic in (b'P1', b'P4'):
+            return read_pbm(fname, band_bytes)
+        import PyQt5.QtGui as QtGui
+        image = QtGui.QImage(fname)
+        if image.isNull() or image.depth() != 1:
+            raise RuntimeError('%s is not a 1 bit image' % fname)
+        return bitmap_from_qimage(image)
+
+def detect_black_index(image):
+    colortable = image.colorTable()
+    assert(len(colortable) == 2)
+    if(colortable[0] > colortable[1]):
+        return 1
+    return 0
+
+def bitmap_from_qimage(image):
+    """Wrap the pixels of a 1 bit QImage without copying them."""
+    import PyQt5.QtGui as QtGui
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine()*image.height())
+    lsb_first = image.format() == QtGui.QImage.Format_MonoLSB
+    return Bitmap.from_buffer(bits, image.width(), image.height(), image.bytesPerLine(),
+                              detect_black_index(image), lsb_first, owner=image)
+
+def calculate_cutlines_locations(sums, noise=no_filter):
+    """Find the strips of rows or columns with ink from their black
+    pixel counts. Returns (first, last) pairs of indices."""
+    ink = numpy.asarray(sums) >= max(noise.min_ink, 1)
+    edges = numpy.diff(numpy.concatenate(([0], ink.astype(numpy.int8), [0])))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1) - 1
+    if len(starts) > 1:
+        # Strips separated by a narrow gap are joined first, so that
+        # letters made of thin parts such as = are not dropped.
+        separate = starts[1:] - ends[:-1] - 1 >= noise.min_gap
+        (starts, ends) = (starts[numpy.concatenate(([True], separate))],
+                          ends[numpy.concatenate((separate, [True]))])
+    keep = ends - starts + 1 >= noise.min_strip
+    (starts, ends) = (starts[keep], ends[keep])
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def strip_letter_rects(bitmap, y0, y1, noise=no_filter):
+    """Split the row strip starting at y0 into letters.
+
+    Returns (x, y, width, height) tuples. The column profile is
+    computed straight from the shared bitmap rows. As in earlier
+    versions the last row and column of a strip are not part of
+    the rectangle."""
+    ystrips = calculate_cutlines_locations(bitmap.column_sums(y0, y1, noise.despeckle), noise)
+    return [(x0, y0, x1-x0, y1-y0) for (x0, x1) in ystrips]
+
+def letter_rects(bitmap, xstrips, noise=no_filter):
+    rects = []
+    for (y0, y1) in xstrips:
+        rects += strip_letter_rects(bitmap, y0, y1, noise)
+    return rects
+
+class SegmentationInterrupted(Exception):
+    pass
+
+def iter_segment(bitmap, segmentation='whitespace', noise=no_filter, interrupted=None):
+    """Find the letters with the given segmentation mode, see
+    gtlib.segmentation_modes. The NoiseFilter applies to white space
+    segmentation.
+
+    Yields (rects, done, total) after every row strip, so callers
+    can use the first boxes and stop early before the whole image
+    has been processed. Connected component segmentation yields
+    once at the end.
+
+    interrupted is an optional function that is called after every
+    band of rows read from the image. If it returns true the
+    segmentation ends without yielding the rest of the boxes."""
+    def check(row=None):
+        if interrupted is not None and interrupted():
+            raise SegmentationInterrupted()
+    try:
+        if segmentation == 'components':
+            with profile.timer('segment.components'):
+                rects = component_rects(bitmap, progress=check)
+            profile.count('boxes', len(rects))
+            yield (rects, 1, 1)
+            return
+        with profile.timer('segment.row_sums'):
+            sums = bitmap.row_sums(progress=check, despeckle=noise.despeckle)
+        with profile.timer('segment.cutlines'):
+            strips = calculate_cutlines_locations(sums, noise)
+        for (i, (y0, y1)) in enumerate(strips):
+            check()
+            with profile.timer('segment.strip'):
+                rects = strip_letter_rects(bitmap, y0, y1, noise)
+            profile.count('boxes', len(rects))
+            yield (rects, i + 1, len(strips))
+    except SegmentationInterrupted:
+        return
+
+def segment(bitmap, segmentation='whitespace', noise=no_filter):
+    rects = []
+    for (r, _, _) in iter_segment(bitmap, segmentation, noise):
+        rects += r
+    return rects
+
+# Connected component segmentation. Works on images where letters
+# are not separated by continuous white strips, such as tilted scans.
+
+def ink_runs(bitmap, progress=None):
+    """Return the horizontal runs of black pixels.
+
+    The result is three arrays: row, first column and one past the
+    last column of every run, sorted by row and column. progress is
+    called with the end row of every band."""
+    rows = []
+    starts = []
+    ends = []
+    for (y0, y1) in bitmap.bands():
+        bits = numpy.unpackbits(bitmap.data[y0:y1], axis=1, count=bitmap.w,
+                                bitorder=bitmap.bitorder)
+        if bitmap.black_index == 0:
+            bits ^= 1
+        padded = numpy.zeros((y1-y0, bitmap.w+2), dtype=numpy.int8)
+        padded[:, 1:-1] = bits
+        edges = numpy.diff(padded, axis=1)
+        (r, c) = numpy.nonzero(edges)
+        rising = edges[r, c] == 1
+        rows.append(r[rising] + y0)
+        starts.append(c[rising])
+        ends.append(c[~rising])
+        if progress is not None:
+            progress(y1)
+    if len(rows) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (empty, empty, empty)
+    return (numpy.concatenate(rows), numpy.concatenate(starts), numpy.concatenate(ends))
+
+def union_find(count, a, b):
+    """Label the connected parts of a graph with count nodes and edges a[i]-b[i].
+
+    Works on whole edge arrays at a time: every round hooks the roots
+    of all edges to the smaller root and then compresses the paths."""
+    labels = numpy.arange(count)
+    while True:
+        la = labels[a]
+        lb = labels[b]
+        differ = la != lb
+        if not differ.any():
+            break
+        (la, lb) = (la[differ], lb[differ])
+        m = numpy.minimum(la, lb)
+        numpy.minimum.at(labels, la, m)
+        numpy.minimum.at(labels, lb, m)
+        while True:
+            compressed = labels[labels]
+            if numpy.array_equal(compressed, labels):
+                break
+            labels = compressed
+    return labels
+
+def connected_runs(rows, starts, ends, width):
+    """Pairs of 8-connected runs on consecutive rows."""
+    stride = width + 2
+    start_keys = rows*stride + starts
+    end_keys = rows*stride + ends
+    # Candidates for each run are the runs on the row above it
+    # that end at or after its start and start at or before its end.
+    above = (rows - 1)*stride
+    lo = numpy.searchsorted(end_keys, above + starts, side='left')
+    hi = numpy.searchsorted(start_keys, above + ends, side='right')
+    counts = numpy.maximum(hi - lo, 0)
+    total = counts.sum()
+    b = numpy.repeat(numpy.arange(len(rows)), counts)
+    first = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    a = numpy.repeat(lo, counts) + numpy.arange(total) - first
+    return (a, b)
+
+def component_boxes(bitmap, progress=None):
+    """Bounding boxes of 8-connected black regions.
+
+    Returns an array of rows (x0, y0, x1, y1, pixel count) with
+    inclusive end coordinates."""
+    (rows, starts, ends) = ink_runs(bitmap, progress)
+    if len(rows) == 0:
+        return numpy.zeros((0, 5), dtype=numpy.int64)
+    (a, b) = connected_runs(rows, starts, ends, bitmap.w)
+    labels = union_find(len(rows), a, b)
+    (_, comp) = numpy.unique(labels, return_inverse=True)
+    order = numpy.argsort(comp, kind='stable')
+    comp = comp[order]
+    cuts = numpy.flatnonzero(numpy.r_[True, comp[1:] != comp[:-1]])
+    boxes = numpy.empty((len(cuts), 5), dtype=numpy.int64)
+    boxes[:, 0] = numpy.minimum.reduceat(starts[order], cuts)
+    boxes[:, 1] = numpy.minimum.reduceat(rows[order], cuts)
+    boxes[:, 2] = numpy.maximum.reduceat(ends[order], cuts) - 1
+    boxes[:, 3] = numpy.maximum.reduceat(rows[order], cuts)
+    boxes[:, 4] = numpy.add.reduceat((ends - starts)[order], cuts)
+    return boxes
+
+def merge_pairs(boxes, max_gap, small_height):
+    """Find pairs of component boxes that belong to the same glyph.
+
+    Boxes that mostly overlap are merged, as are small marks such
+    as the dot of an i or an accent lying directly above or below
+    another box."""
+    order = numpy.argsort(boxes[:, 0], kind='stable')
+    boxes = boxes[order]
+    (x0, y0, x1, y1) = (boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3])
+    # Both rules need the boxes to overlap horizontally, so only
+    # boxes starting within the extent of another one are candidates.
+    hi = numpy.searchsorted(x0, x1, side='right')
+    counts = numpy.maximum(hi - numpy.arange(len(boxes)) - 1, 0)
+    a = numpy.repeat(numpy.arange(len(boxes)), counts)
+    first = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    b = a + 1 + numpy.arange(counts.sum()) - first
+    widths = x1 - x0 + 1
+    heights = y1 - y0 + 1
+    xover = numpy.minimum(x1[a], x1[b]) - numpy.maximum(x0[a], x0[b]) + 1
+    yover = numpy.minimum(y1[a], y1[b]) - numpy.maximum(y0[a], y0[b]) + 1
+    smaller_area = numpy.minimum(widths[a]*heights[a], widths[b]*heights[b])
+    contained = (yover > 0) & (2*xover*yover >= smaller_area)
+    # A negative overlap is the size of the gap between the boxes.
+    mark = (2*xover >= numpy.minimum(widths[a], widths[b])) & (-yover <= max_gap) & \
+        (numpy.minimum(heights[a], heights[b]) <= small_height)
+    keep = contained | mark
+    return (order[a[keep]], order[b[keep]])
+
+def reading_order(rects):
+    """Sort (x, y, w, h) rectangles into text lines, top to bottom
+    and left to right within a line."""
+    lines = []
+    for r in sorted(rects, key=lambda r: (r[1], r[0])):
+        center = r[1] + r[3]/2
+        if len(lines) > 0 and center < lines[-1][0]:
+            (bottom, line) = lines[-1]
+            line.append(r)
+            lines[-1] = (max(bottom, r[1] + r[3]), line)
+        else:
+            lines.append((r[1] + r[3], [r]))
+    result = []
+    for (_, line) in lines:
+        result += sorted(line)
+    return result
+
+def component_rects(bitmap, gap_ratio=0.4, mark_ratio=0.6, progress=None):
+    """Segment the image into glyphs using connected components.
+
+    Components closer than gap_ratio times the median component
+    height are grouped together if one of them is at most
+    mark_ratio times the median height. Returns (x, y, width, height)
+    tuples in reading order. progress is called after every band of
+    rows read from the image."""
+    boxes = component_boxes(bitmap, progress)
+    if len(boxes) == 0:
+        return []
+    median_height = numpy.median(boxes[:, 3] - boxes[:, 1] + 1)
+    while True:
+        (a, b) = merge_pairs(boxes, gap_ratio*median_height, mark_ratio*median_height)
+        if len(a) == 0:
+            break
+        labels = union_find(len(boxes), a, b)
+        (_, comp) = numpy.unique(labels, return_inverse=True)
+        merged = numpy.empty((comp.max() + 1, 5), dtype=numpy.int64)
+        merged[:, 0:2] = numpy.iinfo(numpy.int64).max
+        merged[:, 2:4] = -1
+        merged[:, 4] = 0
+        numpy.minimum.at(merged[:, 0], comp, boxes[:, 0])
+        numpy.minimum.at(merged[:, 1], comp, boxes[:, 1])
+        numpy.maximum.at(merged[:, 2], comp, boxes[:, 2])
+        numpy.maximum.at(merged[:, 3], comp, boxes[:, 3])
+        numpy.add.at(merged[:, 4], comp, boxes[:, 4])
+        boxes = merged
+    rects = [(int(b[0]), int(b[1]), int(b[2] - b[0] + 1), int(b[3] - b[1] + 1)) for b in boxes]
+    return reading_order(rects)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Writing traced glyphs as a UFO 3 font.
+#
+# Every glyph is a separate .glif file, so glyphs are written by the
+# worker threads as soon as they have been traced. The font is built
+# in a temporary directory next to the output and moved in place when
+# it is complete.
+
+import os, shutil, tempfile, plistlib
+import concurrent.futures
+from xml.sax.saxutils import quoteattr
+from gtlib import *
+from gtprofile import profile
+
+ufo_creator = 'com.github.jpakkane.glyphtracer'
+ufo_format_version = 3
+glyphs_directory = 'glyphs'
+
+# Characters that can not be used in file names on some systems,
+# and names that are reserved on Windows.
+illegal_file_characters = set('"*+/:<>?[\\]|\x7f' + ''.join([chr(i) for i in range(32)]))
+reserved_file_names = set(['con', 'prn', 'aux', 'clock$', 'nul'] +
+                          ['com%d' % i for i in range(1, 10)] +
+                          ['lpt%d' % i for i in range(1, 10)])
+max_file_name = 255
+
+def glyph_file_name(name, existing):
+    """File name of a glyph following the UFO 3 user name to file
+    name convention. existing is the set of lower case file names
+    already used, the new name is added to it."""
+    if name.startswith('.'):
+        name = '_' + name[1:]
+    chars = []
+    for c in name:
+        if c in illegal_file_characters:
+            c = '_'
+        elif c != c.lower():
+            # Upper case letters are marked so that names differing
+            # only in case do not clash on case insensitive systems.
+            c += '_'
+        chars.append(c)
+    parts = ''.join(chars).split('.')
+    parts = ['_' + p if p.lower() in reserved_file_names else p for p in parts]
+    base = '.'.join(parts)[:max_file_name - len('.glif')]
+    fname = base + '.glif'
+    number = 1
+    while fname.lower() in existing:
+        suffix = '%015d' % number
+        fname = base[:max_file_name - len('.glif') - len(suffix)] + suffix + '.glif'
+        number += 1
+    existing.add(fname.lower())
+    return fname
+
+def unique_glyph_names(glyphs):
+    """UFO names of glyphs. Glyph names must be unique in a UFO font,
+    but the glyph groups use some names for more than one code point.
+    Later glyphs with a name already in use are called uniXXXX."""
+    names = []
+    used = set()
+    for g in glyphs:
+        name = g.name
+        if name in used:
+            if g.codepoint > 0xffff:
+                name = 'u%05X' % g.codepoint
+            else:
+                name = 'uni%04X' % g.codepoint
+            if name in used:
+                raise RuntimeError('Glyph name %s is used twice' % name)
+        used.add(name)
+        names.append(name)
+    return names
+
+def format_number(value):
+    if value == int(value):
+        return str(int(value))
+    return str(value)
+
+def glif_point(x, y, scale, kind=None):
+    attributes = 'x="%s" y="%s"' % (format_number(scale*x), format_number(scale*y))
+    if kind is not None:
+        attributes += ' type="%s"' % kind
+    return '      <point %s/>\n' % attributes
+
+def glif_text(name, glyph, points, scale):
+    """The .glif XML of a glyph called name in the font. points are
+    the traced curves as given to write_glyph."""
+    width = glyph.box.r.width()*potrace_pixel_multiplier*scale + rbearing
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<glyph name=%s format="2">\n' % quoteattr(name),
+             '  <advance width="%d"/>\n' % width,
+             '  <unicode hex="%04X"/>\n' % glyph.codepoint,
+             '  <outline>\n']
+    for curve in points:
+        # Contours are closed, the last segment ends at the first
+        # point so it is not written separately.
+        lines.append('    <contour>\n')
+        for point in curve[1:]:
+            if len(point) == 6:
+                lines.append(glif_point(point[0], point[1], scale))
+                lines.append(glif_point(point[2], point[3], scale))
+                lines.append(glif_point(point[4], point[5], scale, 'curve'))
+            elif len(point) == 2:
+                lines.append(glif_point(point[0], point[1], scale, 'line'))
+            else:
+                raise RuntimeError('Incorrect amount of points: %d' % len(point))
+        lines.append('    </contour>\n')
+    lines += ['  </outline>\n', '</glyph>\n']
+    return ''.join(lines)
+
+def write_glif(fname, name, glyph, points, scale):
+    with profile.timer('write.glyph'):
+        data = glif_text(name, glyph, points, scale).encode('utf-8')
+        with open(fname, 'wb') as f:
+            f.write(data)
+    profile.glyph(glyph, bytes=len(data))
+    profile.count('bytes_written', len(data))
+
+def write_plist(fname, value):
+    with open(fname, 'wb') as f:
+        plistlib.dump(value, f)
+
+def font_info(fontname):
+    return {'familyName': fontname,
+            'styleName': 'Regular',
+            'postscriptFontName': fontname,
+            'postscriptFullName': fontname,
+            'copyright': 'Originally traced with %s' % program_name,
+            'versionMajor': 1,
+            'versionMinor': 0,
+            'unitsPerEm': total_height,
+            'ascender': ascent,
+            'descender': -descent,
+            'italicAngle': 0,
+            'postscriptUnderlinePosition': -100,
+            'postscriptUnderlineThickness': 50}
+
+def is_ufo(dirname):
+    return os.path.isfile(os.path.join(dirname, 'metainfo.plist'))
+
+def replace_directory(tempname, odirname):
+    """Move the finished font in place of the old one."""
+    if not os.path.exists(odirname):
+        os.rename(tempname, odirname)
+        return
+    oldname = tempfile.mkdtemp(dir=os.path.dirname(odirname),
+                               prefix=os.path.basename(odirname), suffix='.old')
+    os.rmdir(oldname)
+    os.rename(odirname, oldname)
+    os.rename(tempname, odirname)
+    shutil.rmtree(oldname)
+
+def write_ufo(odirname, fontname, image, glyphs, jobs=None, cache=None, tracer=None,
+              whole_page=False):
+    """Write glyphs as a UFO font directory odirname, replacing an
+    existing UFO font. Glyph files are written in parallel with jobs
+    workers."""
+    odirname = os.path.abspath(odirname)
+    if os.path.exists(odirname) and not is_ufo(odirname):
+        raise RuntimeError('%s exists and is not a UFO font' % odirname)
+    glyphs = [g for g in glyphs if g.box is not None]
+    scale = calculate_scale(glyphs)
+    if jobs is None:
+        jobs = default_jobs()
+    tempname = tempfile.mkdtemp(dir=os.path.dirname(odirname),
+                                prefix=os.path.basename(odirname), suffix='.tmp')
+    try:
+        glyphdir = os.path.join(tempname, glyphs_directory)
+        os.mkdir(glyphdir)
+        names = dict([(id(g), name) for (g, name) in zip(glyphs, unique_glyph_names(glyphs))])
+        used = set()
+        contents = {}
+        for g in glyphs:
+            contents[names[id(g)]] = glyph_file_name(names[id(g)], used)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = []
+            try:
+                for (glyph, points) in traced_glyphs(image, glyphs, jobs, cache, tracer, whole_page):
+                    name = names[id(glyph)]
+                    futures.append(executor.submit(write_glif, os.path.join(glyphdir, contents[name]),
+                                                   name, glyph, points, scale))
+                for future in futures:
+                    future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+        write_plist(os.path.join(glyphdir, 'contents.plist'), contents)
+        write_plist(os.path.join(tempname, 'layercontents.plist'),
+                    [['public.default', glyphs_directory]])
+        write_plist(os.path.join(tempname, 'fontinfo.plist'), font_info(fontname))
+        write_plist(os.path.join(tempname, 'lib.plist'),
+                    {'public.glyphOrder': [names[id(g)] for g in glyphs]})
+        write_plist(os.path.join(tempname, 'metainfo.plist'),
+                    {'creator': ufo_creator, 'formatVersion': ufo_format_version})
+        # mkdtemp makes the directory accessible by the owner only.
+        os.chmod(tempname, replacement_mode(odirname, 0o777))
+        replace_directory(tempname, odirname)
+    except:
+        shutil.rmtree(tempname, ignore_errors=True)
+        raise
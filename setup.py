@@ -26,7 +26,7 @@ setup(name = gtlib.program_name.lower(),
       author='Jussi Pakkanen',
       author_email='jpakkane@gmail.com',
       url='https://github.com/jpakkane/glyphtracer',
-      py_modules = ['gtlib'],
+      py_modules = ['gtlib', 'gtsegment', 'gtcache', 'gtbatch', 'gtproject', 'gtbench', 'gtprofile', 'gtufo'],
       scripts = ['glyphtracer.py'],
       classifiers = ['License :: OSI Approved :: GNU General Public License (GPL)',
                      'Topic :: Multimedia :: Graphics :: Editors :: Vector-Based',
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the white space segmentation.
+#
+#     python3 -m unittest test_segment
+
+import unittest
+from gtsegment import *
+
+class CutlineTest(unittest.TestCase):
+    def test_no_filter(self):
+        sums = [0, 5, 5, 5, 0, 0, 5, 5, 5, 0]
+        self.assertEqual(calculate_cutlines_locations(sums), [(1, 3), (6, 8)])
+
+    def test_narrow_gap_joins_strips(self):
+        sums = [0, 5, 5, 5, 0, 0, 5, 5, 5, 0]
+        self.assertEqual(calculate_cutlines_locations(sums, NoiseFilter(min_gap=3)), [(1, 8)])
+
+    def test_thin_parts_are_joined_before_dropping(self):
+        # A letter such as = is made of strips thinner than min_strip.
+        sums = [0, 5, 5, 5, 0, 0, 5, 5, 5, 0]
+        noise = NoiseFilter(min_strip=4, min_gap=3)
+        self.assertEqual(calculate_cutlines_locations(sums, noise), [(1, 8)])
+
+    def test_isolated_dust_is_dropped(self):
+        sums = [0, 1, 0, 0, 0, 0, 5, 5, 5, 5, 5, 0, 0, 0, 0, 1, 0]
+        noise = NoiseFilter(min_strip=4, min_gap=3)
+        self.assertEqual(calculate_cutlines_locations(sums, noise), [(6, 10)])
+
+    def test_min_ink(self):
+        sums = [0, 1, 5, 5, 1, 0]
+        self.assertEqual(calculate_cutlines_locations(sums, NoiseFilter(min_ink=2)), [(2, 3)])
+
+if __name__ == '__main__':
+    unittest.main()
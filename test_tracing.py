@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+#    Glyphtracer
+#    Copyright (C) 2010-2021 Jussi Pakkanen
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the tracing backends on a generated sheet. Tests that need
+# a backend that is not available are skipped.
+#
+#     python3 -m unittest test_tracing
+
+import os, tempfile, types, unittest
+import numpy
+from gtlib import *
+import gtsegment
+import gtbench
+
+def available_tracer(name):
+    try:
+        return find_tracer(name)
+    except RuntimeError:
+        return None
+
+program = available_tracer('program')
+library = available_tracer('library')
+
+def sample_sheet(glyphs=40, seed=1):
+    """A bitmap of generated glyphs and GlyphInfos for its boxes."""
+    pixels = gtbench.generate_sheet(glyphs, 300, 4.0, seed)
+    (h, w) = pixels.shape
+    bitmap = gtsegment.Bitmap(numpy.packbits(pixels, axis=1), w, h, 1)
+    result = []
+    for (i, box) in enumerate(rects_to_boxes(gtsegment.segment(bitmap))):
+        glyph = GlyphInfo('glyph%d' % i, 0xe000 + i)
+        glyph.box = box
+        result.append(glyph)
+    return (bitmap, result)
+
+def sfd_bytes(bitmap, glyphs, tracer, whole_page=False):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'test.sfd')
+        write_sfd(fname, 'Test', bitmap, glyphs, 2, None, tracer, whole_page)
+        with open(fname, 'rb') as f:
+            return f.read()
+
+def outline_points(curve, steps=100):
+    """Points along a traced contour."""
+    t = numpy.linspace(0.0, 1.0, steps)[:, None]
+    u = 1.0 - t
+    result = []
+    current = numpy.array(curve[0][-2:])
+    for point in curve[1:]:
+        p = numpy.array(point, dtype=float).reshape(-1, 2)
+        if len(p) == 1:
+            result.append(u*current + t*p[0])
+        else:
+            result.append(u**3*current + 3*u*u*t*p[0] + 3*u*t*t*p[1] + t**3*p[2])
+        current = p[-1]
+    return numpy.concatenate(result)
+
+def outline_distance(curve1, curve2):
+    """Largest distance from a point of either contour to the other
+    one, in pixels."""
+    p1 = outline_points(curve1)
+    p2 = outline_points(curve2)
+    d = numpy.sqrt(((p1[:, None, :] - p2[None, :, :])**2).sum(axis=2))
+    return max(d.min(axis=0).max(), d.min(axis=1).max())/potrace_pixel_multiplier
+
+# Tracing results recorded for the bitmap below, so that the two
+# backends' conversions can be compared without either of them
+# installed: the path commands in the form potrace writes them with
+# potrace_arguments, and the curves that pypotrace returns. They were
+# recorded from the potracer port of potrace.
+#
+#     ....................
+#     .....######.........
+#     ...##########.......
+#     ..###......###......
+#     ..##........##......
+#     ..##........##......
+#     ..###......###......
+#     ...##########.......
+#     .....######.........
+#     ....................
+#     ....................
+#     ..###############...
+#     ..###############...
+#     ..###############...
+#     ..####..............
+#     ..####..............
+#     ..####..............
+#     ....................
+
+recorded_eps = [
+    '36 157 moveto',
+    '-43 -32 15 -81 71 -61 rcurveto',
+    '15 5 29 18 31 29 rcurveto',
+    '8 38 -63 60 -102 32 rcurveto',
+    'closepath',
+    '115 130 moveto',
+    '0 -18 -52 -27 -67 -12 rcurveto',
+    '-17 17 2 33 35 30 rcurveto',
+    '20 -2 32 -8 32 -18 rcurveto',
+    'closepath',
+    '20 40 moveto',
+    '0 -23 4 -30 20 -30 rcurveto',
+    '11 0 20 7 20 15 rcurveto',
+    '0 12 13 15 55 15 rcurveto',
+    '42 0 55 3 55 15 rcurveto',
+    '0 12 -15 15 -75 15 rcurveto',
+    '-75 0 rlineto',
+    '0 -30 rlineto',
+    'closepath',
+]
+
+recorded_library_curves = [
+    ((3.582389037649171, 15.683902753258643), [
+        (False, (-0.7426654857525135, 12.521345671486598), (5.052708996883722, 7.577409774586247), (10.740284644076363, 9.577623143388962)),
+        (False, (12.247441198318363, 10.107661753101604), (13.64637446717343, 11.402286761506106), (13.849025241532072, 12.454567606510075)),
+        (False, (14.588519063838254, 16.294450215763884), (7.476657941114538, 18.531461699010976), (3.582389037649171, 15.683902753258643)),
+    ]),
+    ((11.5, 13.0), [
+        (False, (11.5, 11.240372531837359), (6.265379020468594, 10.334620979531406), (4.7653099589832095, 11.83469004101679)),
+        (False, (3.0838998477543353, 13.516100152245665), (5.02553214146078, 15.12845891092326), (8.343848759773058, 14.806358980302305)),
+        (False, (10.346490315395982, 14.611968034433835), (11.5, 13.951780223693714), (11.5, 13.0)),
+    ]),
+    ((2.0, 4.0), [
+        (False, (2.0, 1.666666666666667), (2.4444444444444446, 1.0), (4.0, 1.0)),
+        (False, (5.111111111111111, 1.0), (6.0, 1.666666666666667), (6.0, 2.5)),
+        (False, (6.0, 3.6515151515151514), (7.277777777777777, 4.0), (11.5, 4.0)),
+        (False, (15.722222222222223, 4.0), (17.0, 4.348484848484849), (17.0, 5.5)),
+        (False, (17.0, 6.699999999999999), (15.499999999999998, 7.0), (9.5, 7.0)),
+        (True, (2.0, 7.0), None, (2.0, 4.0)),
+    ]),
+]
+
+def library_curves(recorded):
+    """Objects with the attributes of pypotrace's curves."""
+    curves = []
+    for (start, segments) in recorded:
+        curve = types.SimpleNamespace(start_point=start, segments=[])
+        for (is_corner, c1, c2, end) in segments:
+            segment = types.SimpleNamespace(is_corner=is_corner, end_point=end)
+            if is_corner:
+                segment.c = c1
+            else:
+                (segment.c1, segment.c2) = (c1, c2)
+            curve.segments.append(segment)
+        curves.append(curve)
+    return curves
+
+class RecordedTraceTest(unittest.TestCase):
+    def test_recorded_paths_agree(self):
+        (eps_kinds, eps_coords) = eps_paths(recorded_eps)
+        (kinds, coords) = library_paths(library_curves(recorded_library_curves))
+        self.assertEqual(eps_kinds.tolist(), kinds.tolist())
+        self.assertEqual(eps_coords.tolist(), coords.tolist())
+
+    def test_recorded_glyphs_agree(self):
+        glyph = GlyphInfo('a', ord('a'))
+        glyph.box = LetterBox(Rect(0, 0, 20, 18))
+        scale = calculate_scale([glyph])
+        program_text = glyph_text(glyph, paths_to_curves(*eps_paths(recorded_eps)), scale)
+        library_text = glyph_text(glyph, paths_to_curves(*library_paths(
+            library_curves(recorded_library_curves))), scale)
+        self.assertEqual(program_text, library_text)
+
+class BackendTest(unittest.TestCase):
+    @unittest.skipIf(program is None or library is None,
+                     'needs both the potrace executable and pypotrace')
+    def test_backends_write_same_sfd(self):
+        (bitmap, glyphs) = sample_sheet()
+        self.assertEqual(sfd_bytes(bitmap, glyphs, program),
+                         sfd_bytes(bitmap, glyphs, library))
+
+class PageTest(unittest.TestCase):
+    @unittest.skipIf(program is None and library is None, 'needs a potrace backend')
+    def test_whole_page_matches_glyphs(self):
+        # Whole page tracing is not exact, see trace_page. The
+        # contours must still be the same and lie close together.
+        tracer = program or library
+        (bitmap, glyphs) = sample_sheet()
+        single = list(trace_glyphs(bitmap, glyphs, 2, None, tracer))
+        page = list(trace_page(bitmap, glyphs, 2, tracer))
+        self.assertEqual([g.name for (g, c) in single], [g.name for (g, c) in page])
+        for ((glyph, curves1), (_, curves2)) in zip(single, page):
+            self.assertEqual(len(curves1), len(curves2), glyph.name)
+            for (c1, c2) in zip(curves1, curves2):
+                if c1 != c2:
+                    self.assertLess(outline_distance(c1, c2), 0.5, glyph.name)
+
+if __name__ == '__main__':
+    unittest.main()